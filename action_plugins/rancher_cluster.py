@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+
+from importlib.util import module_from_spec, spec_from_file_location
+
+
+def load_rancher_controller():
+    # module_utils/ next to the playbooks is only importable by modules, load the helper by path
+    name = 'ansible_rancher_controller'
+    if name not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils',
+                            'rancher_controller.py')
+        spec = spec_from_file_location(name, path)
+        sys.modules[name] = module_from_spec(spec)
+        spec.loader.exec_module(sys.modules[name])
+    return sys.modules[name]
+
+
+class ActionModule(load_rancher_controller().RancherAction):
+
+    # runs library/<task action>.py in the worker process, see module_utils/rancher_controller.py.  The
+    # plugins of the other modules are symlinks to this file
+    pass
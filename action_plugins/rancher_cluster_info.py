@@ -0,0 +1 @@
+rancher_cluster.py
\ No newline at end of file
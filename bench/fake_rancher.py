@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# An in-memory stand-in for the parts of the Rancher v3 API the modules use, for benchmarks and
+# offline runs of kubernetes.yaml.
+#
+#   python3 bench/fake_rancher.py --port 18080 --latency 0.02 --transition 5 --clusters 20 --nodes 500
+#
+# Clusters, node drivers and nodes report 'provisioning' (or 'downloading') for --transition seconds
+# after they were created before they become 'active'.  Node pools create and remove their nodes to
+# match their quantity and their nodes become active one after the other.  Every cluster gets a
+# registration token and generateKubeconfig hands out a new token each time, like Rancher does.
+# POST /v3/tokens logs in; bearer tokens are answered with 401 once they expired or were deleted, basic
+# auth is always accepted.  PUT /v3/tokens/<id> {"expired": true} expires a token early.  Collections are
+# paginated, carry an ETag and are gzip compressed when the client accepts it.  GET /stats returns request,
+# connection, byte and auth scheme counters, DELETE /stats resets them.  /v3/subscribe is not implemented,
+# so wait_for_state() polls.
+#
+# POST /delay {"method": "POST", "path": "/v3/nodepool", "seconds": 3, "count": 1} answers the next count API
+# requests with that method (and path) only after the given seconds, once they took effect, like a Rancher
+# that is slow to respond.
+#
+# --error-rate answers that share of the API requests with a 503 and an HTML body, like a busy load
+# balancer in front of Rancher, with a Retry-After header when --retry-after is set.
+
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+
+# kind -> (id prefix, collection name in links, state while transitioning)
+KINDS = {
+    'cluster': ('c-', 'clusters', 'provisioning'),
+    'nodepool': ('np-', 'nodePools', None),
+    'nodetemplate': ('nt-', 'nodeTemplates', None),
+    'nodedriver': ('nd-', 'nodeDrivers', 'downloading'),
+    'clusterregistrationtoken': ('crt-', 'clusterRegistrationTokens', None),
+    'node': ('m-', 'nodes', 'provisioning'),
+    'token': ('kubeconfig-u-', 'tokens', None),
+}
+
+# /v3/clusters, /v3/nodePools, ... -> cluster, nodepool, ...
+COLLECTIONS = dict((name.lower(), kind) for kind, (prefix, name, transition) in KINDS.items())
+
+# objects removed along with their cluster or node pool
+CHILDREN = {
+    'cluster': [('nodepool', 'clusterId'), ('clusterregistrationtoken', 'clusterId'), ('node', 'clusterId')],
+    'nodepool': [('node', 'nodePoolId')],
+}
+
+# query parameters that are not field filters
+RESERVED_PARAMS = ('limit', 'marker', 'sort', 'order', 'action')
+
+
+class FakeRancher(object):
+
+    def __init__(self, latency=0.0, transition=0.0, token_ttl=86400, compress=True, error_rate=0.0, retry_after=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.transition = transition
+        self.token_ttl = token_ttl
+        self.compress = compress
+        self.objects = dict((kind, {}) for kind in KINDS)
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.revision = 1
+        self.delays = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = dict(requests=0, connections=0, bytes_in=0, bytes_out=0, methods={}, status={}, auth={})
+
+    def count(self, method, status, bytes_in, bytes_out, connection=False):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['connections'] += int(connection)
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out
+            self.stats['methods'][method] = self.stats['methods'].get(method, 0) + 1
+            self.stats['status'][str(status)] = self.stats['status'].get(str(status), 0) + 1
+
+    def delay(self, method, path):
+        # seconds to hold back the answer to this request, see POST /delay
+        with self.lock:
+            for delay in self.delays:
+                if delay['method'] == method and path.startswith(delay['path']) and delay['count'] > 0:
+                    delay['count'] -= 1
+                    return delay['seconds']
+        return 0
+
+    def seed(self, base, clusters=0, nodes=0, ready=True):
+        # pre-populate clusters and nodes (spread over the clusters), already active unless ready is False
+        created = [self.create(base, 'cluster', dict(name='bench-{}'.format(i))) for i in range(clusters)]
+        for i in range(nodes):
+            cluster = created[i % len(created)] if created else None
+            self.create(base, 'node', dict(name='', hostname='bench-node-{}'.format(i),
+                                           clusterId=cluster['id'] if cluster else None,
+                                           worker=True, ipAddress='10.0.{}.{}'.format(i // 250, i % 250 + 1)))
+        if ready:
+            with self.lock:
+                for kind in self.objects.values():
+                    for item in kind.values():
+                        item['_ready'] = 0
+
+    def create(self, base, kind, data):
+        prefix, collection, transition = KINDS[kind]
+        with self.lock:
+            object_id = data.get('id') or '{}{}'.format(prefix, next(self.ids))
+            link = '{}/v3/{}/{}'.format(base, collection, object_id)
+            item = dict(data, id=object_id, type=kind, baseType=kind, created=time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                        links=dict(self=link, remove=link, update=link))
+            item['_ready'] = time.time() + (self.transition if transition else 0)
+            self.objects[kind][object_id] = item
+            self.revision += 1
+
+            if kind == 'cluster':
+                self.create(base, 'clusterregistrationtoken', dict(name='default-token', clusterId=object_id))
+            if kind == 'clusterregistrationtoken':
+                # Rancher fills in the commands of every token, also of the ones created through the API
+                manifest = '{}/v3/import/{}.yaml'.format(base, object_id)
+                item.update(
+                    command='kubectl apply -f {}'.format(manifest),
+                    nodeCommand='sudo docker run -d rancher/rancher-agent --server {} --token {}'.format(base, object_id),
+                    insecureCommand='curl --insecure -sfL {} | kubectl apply -f -'.format(manifest),
+                    manifestUrl=manifest)
+            if kind == 'nodepool':
+                self.scale(base, item)
+            return item
+
+    def update(self, base, kind, object_id, data):
+        with self.lock:
+            item = self.objects[kind][object_id]
+            if kind == 'nodedriver' and any(key in data and data[key] != item.get(key) for key in ('url', 'checksum')):
+                # a new binary is downloaded
+                item['_ready'] = time.time() + self.transition
+            item.update((key, value) for key, value in data.items() if key not in ('id', 'type', 'links'))
+            self.revision += 1
+            if kind == 'nodepool':
+                self.scale(base, item)
+            return item
+
+    def remove(self, kind, object_id):
+        with self.lock:
+            item = self.objects[kind].pop(object_id)
+            self.revision += 1
+            for child, key in CHILDREN.get(kind, []):
+                for other in [other for other in self.objects[child].values() if other.get(key) == object_id]:
+                    self.remove(child, other['id'])
+            return item
+
+    def scale(self, base, pool):
+        nodes = sorted((node for node in self.objects['node'].values() if node.get('nodePoolId') == pool['id']),
+                       key=lambda node: node['id'])
+        for node in nodes[pool.get('quantity') or 0:]:
+            self.objects['node'].pop(node['id'])
+        for index in range(len(nodes), pool.get('quantity') or 0):
+            hostname = '{}{}'.format(pool.get('hostnamePrefix') or pool.get('name', 'node'), index + 1)
+            node = self.create(base, 'node', dict(
+                name='', hostname=hostname, nodeName=hostname, requestedHostname=hostname,
+                clusterId=pool.get('clusterId'), nodePoolId=pool['id'],
+                controlPlane=pool.get('controlPlane', False), etcd=pool.get('etcd', False),
+                worker=pool.get('worker', False), ipAddress='10.1.{}.{}'.format(index // 250, index % 250 + 1)))
+            # the nodes of a pool come up one after the other, the last one after twice the transition time
+            node['_ready'] += self.transition * index / float(pool['quantity'])
+
+    def login(self, base, ttl=None):
+        # POST /v3/tokens, ttl in milliseconds like Rancher, the secret is only returned here
+        ttl = ttl / 1000.0 if ttl else self.token_ttl
+        expires = time.gmtime(time.time() + ttl) if ttl else None
+        token = self.create(base, 'token', dict(
+            name='', enabled=True, expired=False, ttl=int(ttl * 1000),
+            expiresAt=time.strftime('%Y-%m-%dT%H:%M:%SZ', expires) if expires else ''))
+        token['name'] = token['id']
+        return dict(self.view(token), token='{}:secret'.format(token['id']))
+
+    def authenticate(self, header):
+        # basic auth is taken as is, bearer tokens must exist and not have expired
+        scheme = (header or '').split(' ')[0].lower() or 'none'
+        with self.lock:
+            self.stats['auth'][scheme] = self.stats['auth'].get(scheme, 0) + 1
+            if scheme != 'bearer':
+                return True
+            token = self.objects['token'].get(header.split(' ', 1)[1].split(':')[0])
+        if not token or not token.get('enabled', True) or token.get('expired'):
+            return False
+        return not token.get('expiresAt') or token['expiresAt'] > time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    def generate_kubeconfig(self, base, cluster):
+        expires = time.gmtime(time.time() + self.token_ttl) if self.token_ttl else None
+        token = self.create(base, 'token', dict(
+            name='', clusterId=cluster['id'], enabled=True, expired=False,
+            expiresAt=time.strftime('%Y-%m-%dT%H:%M:%SZ', expires) if expires else ''))
+        token['name'] = token['id']
+        return dict(type='generateKubeConfigOutput', config='\n'.join([
+            'apiVersion: v1', 'kind: Config',
+            'clusters:', '- name: "{}"'.format(cluster.get('name')), '  cluster:',
+            '    server: "{}/k8s/clusters/{}"'.format(base, cluster['id']),
+            'users:', '- name: "{}"'.format(cluster.get('name')), '  user:',
+            '    token: "{}:secret"'.format(token['id']),
+            'contexts:', '- name: "{}"'.format(cluster.get('name')), '  context:',
+            '    user: "{}"'.format(cluster.get('name')), '    cluster: "{}"'.format(cluster.get('name')),
+            'current-context: "{}"'.format(cluster.get('name')), '']))
+
+    def view(self, item):
+        # objects are stored with the time they become active, the state is derived when they are read
+        item = dict(item)
+        ready = item.pop('_ready', 0)
+        transition = KINDS[item['type']][2]
+        if transition:
+            active = time.time() >= ready
+            item['state'] = 'active' if active else transition
+            item['transitioning'] = 'no' if active else 'yes'
+            item['transitioningMessage'] = '' if active else 'Waiting for {} to become active'.format(item['type'])
+            if item['type'] == 'nodedriver':
+                item['active'] = active
+        else:
+            item.setdefault('state', 'active')
+        return item
+
+    def collection(self, base, path, kind, params):
+        filters = dict((key, value) for key, value in params.items() if key not in RESERVED_PARAMS)
+        with self.lock:
+            items = [self.view(item) for item in sorted(self.objects[kind].values(), key=lambda item: item['id'])]
+        items = [item for item in items if all(text(item.get(key)) == value for key, value in filters.items())]
+
+        limit, marker = int(params.get('limit') or 1000), int(params.get('marker') or 0)
+        pagination = dict(limit=limit, total=len(items))
+        if 0 < limit < len(items) - marker:
+            pagination['next'] = '{}{}?{}'.format(base, path, urlencode(dict(params, marker=marker + limit)))
+        if limit > 0:
+            items = items[marker:marker + limit]
+        return dict(type='collection', resourceType=kind, revision=str(self.revision),
+                    pagination=pagination, data=items)
+
+
+def text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return '' if value is None else str(value)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'fake-rancher'
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        rancher = self.server.rancher
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if rancher.latency:
+            time.sleep(rancher.latency)
+
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        base = 'http://{}'.format(self.headers.get('Host'))
+        segments = [segment for segment in parts.path.split('/') if segment]
+
+        if segments == ['stats']:
+            if method == 'DELETE':
+                rancher.reset_stats()
+            return self.send(200, rancher.stats, count=False)
+
+        if segments == ['delay'] and method == 'POST':
+            delay = json.loads(raw.decode('utf-8'))
+            with rancher.lock:
+                rancher.delays.append(dict(method=delay.get('method', 'POST'), path=delay.get('path', '/'),
+                                           seconds=float(delay['seconds']), count=int(delay.get('count', 1))))
+            return self.send(200, dict(delays=rancher.delays), count=False)
+
+        try:
+            body = json.loads(raw.decode('utf-8')) if raw else {}
+        except ValueError:
+            return self.send(422, error(422, 'InvalidBodyContent'), len(raw))
+
+        if rancher.error_rate and random.random() < rancher.error_rate:
+            return self.unavailable(len(raw))
+
+        if not rancher.authenticate(self.headers.get('Authorization')):
+            return self.send(401, error(401, 'Unauthorized'), len(raw))
+
+        if len(segments) < 2 or segments[0] != 'v3':
+            return self.send(404, error(404, 'NotFound'), len(raw))
+        kind = COLLECTIONS.get(segments[1].lower()) or COLLECTIONS.get(segments[1].lower() + 's')
+        if not kind:
+            return self.send(404, error(404, 'NotFound'), len(raw))
+
+        if len(segments) == 2:
+            if method == 'GET':
+                return self.send(200, rancher.collection(base, parts.path, kind, params), len(raw))
+            if method == 'POST':
+                if not body.get('name') and kind in ('cluster', 'nodetemplate', 'nodedriver'):
+                    return self.send(422, error(422, 'MissingRequired', 'name'), len(raw))
+                if kind == 'token':
+                    return self.send(201, rancher.login(base, body.get('ttl')), len(raw))
+                return self.send(201, rancher.view(rancher.create(base, kind, body)), len(raw))
+            return self.send(405, error(405, 'MethodNotAllowed'), len(raw))
+
+        object_id = segments[2]
+        with rancher.lock:
+            item = rancher.objects[kind].get(object_id)
+            if item is None:
+                return self.send(404, error(404, 'NotFound', object_id), len(raw))
+
+            if method == 'GET':
+                return self.send(200, rancher.view(item), len(raw))
+            if method == 'PUT':
+                return self.send(200, rancher.view(rancher.update(base, kind, object_id, body)), len(raw))
+            if method == 'DELETE':
+                return self.send(200, rancher.view(rancher.remove(kind, object_id)), len(raw))
+            if method == 'POST' and kind == 'cluster' and params.get('action') == 'generateKubeconfig':
+                return self.send(200, rancher.generate_kubeconfig(base, item), len(raw))
+        return self.send(405, error(405, 'MethodNotAllowed'), len(raw))
+
+    def send(self, status, resource, bytes_in=0, count=True):
+        body = json.dumps(resource).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+
+        if resource.get('type') == 'collection':
+            etag = '"{}"'.format(hashlib.sha1(json.dumps(resource['data'], sort_keys=True).encode('utf-8')).hexdigest())
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+
+        seconds = self.server.rancher.delay(self.command, self.path) if count else 0
+        if seconds:
+            time.sleep(seconds)
+
+        if body and self.server.rancher.compress and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if count:
+            # one handler per connection, counted with its first request so /stats calls stay out
+            self.server.rancher.count(self.command, status, bytes_in, len(body), not getattr(self, 'counted', False))
+            self.counted = True
+
+    def unavailable(self, bytes_in):
+        body = b'<html><body><h1>503 Service Temporarily Unavailable</h1></body></html>'
+        self.send_response(503)
+        self.send_header('Content-Type', 'text/html')
+        if self.server.rancher.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.rancher.retry_after))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.rancher.count(self.command, 503, bytes_in, len(body), not getattr(self, 'counted', False))
+        self.counted = True
+
+
+class Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients drop their idle keep-alive connections when a module run ends
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+def error(status, code, field=None):
+    resource = dict(type='error', status=status, code=code, message=code)
+    if field:
+        resource['fieldName'] = field
+    return resource
+
+
+def serve(port=0, latency=0.0, transition=0.0, token_ttl=86400, compress=True, clusters=0, nodes=0,
+          error_rate=0.0, retry_after=None):
+    # starts the server on a background thread, returns it with its base url
+    server = Server(('127.0.0.1', port), Handler)
+    server.rancher = FakeRancher(latency, transition, token_ttl, compress, error_rate, retry_after)
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.rancher.seed(base, clusters, nodes)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Rancher v3 API server')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--transition', type=float, default=0.0, help='seconds until new objects are active')
+    parser.add_argument('--token-ttl', type=int, default=86400, help='kubeconfig token lifetime, 0 never expires')
+    parser.add_argument('--no-gzip', action='store_true')
+    parser.add_argument('--clusters', type=int, default=0, help='active clusters to start with')
+    parser.add_argument('--nodes', type=int, default=0, help='active nodes to start with')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 503')
+    parser.add_argument('--retry-after', type=int, help='Retry-After seconds sent with the 503s')
+    args = parser.parse_args()
+
+    server, base = serve(args.port, args.latency, args.transition, args.token_ttl, not args.no_gzip,
+                         args.clusters, args.nodes, args.error_rate, args.retry_after)
+    print('fake Rancher listening on {}'.format(base), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
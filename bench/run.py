@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Runs each library module, and the kubernetes.yaml flow, against bench/fake_rancher.py and reports wall
+# time, requests, connections and bytes transferred per scenario.
+#
+#   python3 bench/run.py                           # all scenarios, modules run through AnsiballZ
+#   python3 bench/run.py --action-plugins          # the same with the in-process action plugins
+#   python3 bench/run.py --latency 0.05 --transition 3 --nodes 2000 cluster nodepool node_info
+#   python3 bench/run.py --json /tmp/bench.json
+#   python3 bench/run.py --budget bench/budget.json          # fail when a task takes other requests than before
+#   python3 bench/run.py --record-budget bench/budget.json   # after a change that is meant to change them
+#
+# Every run gets fresh id cache, snapshot, token and kubeconfig cache files in a temporary directory, the
+# scenarios run in order and later ones use the objects created by earlier ones.  Before each scenario an
+# unmeasured warm-up logs in, then the id cache and the snapshot are deleted: the first task of a scenario
+# pays for its lookups with a cold cache, the tasks after it show the warm path.  The update scenario
+# changes what earlier scenarios created, a driver checksum, a Kubernetes version and pool sizes, and
+# expires the kubeconfig token.
+#
+# With a budget each task's rancher_metrics is compared with the requests, new connections and bytes it
+# took when the budget was recorded, so an extra lookup, a request that went missing or a connection that
+# is no longer reused shows up as a failure.  Requests and bytes sent have to match exactly, see
+# check_budget() for bytes received and tasks with requests in parallel.  The fake server then runs with
+# the settings stored in the budget, not the ones given here.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_rancher  # noqa: E402
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AUTH = dict(host='{{ rancher_host }}', user='{{ rancher_access_key }}', password='{{ rancher_secret_key }}')
+
+TEMPLATE_ARGS = dict(server='eportal', token='secret', region='NYC01', network='UAT1', image='centos7',
+                     engine_install_url='https://releases.rancher.com/install-docker/18.09.sh',
+                     engine_storage_driver='overlay2', engine_options={})
+
+
+CLUSTER_ARGS = dict(region='NYC01', kubernetes_version='v1.15.4-rancher1-2', cni_provider='calico',
+                    ingress_provider='nginx', enable_dvp=False)
+
+DRIVER_ARGS = dict(url='http://driver/bench', uiUrl='http://driver/ui', checksum='0123abcd', wait_for_active=True,
+                   wait_timeout=600)
+
+POOLS = [
+    dict(name='bench-master', prefix='bench-master', quantity=3, controlplane=True, etcd=True, worker=False),
+    dict(name='bench-worker', prefix='bench-worker', quantity=10, controlplane=False, etcd=False, worker=True),
+    dict(name='bench-storage', prefix='bench-storage', quantity=3, controlplane=False, etcd=False, worker=True),
+]
+
+TEMPLATES = [dict(name='bench-{}'.format(role), cpu=2, memory=4, disk=20) for role in ('master', 'worker', 'storage')]
+
+STACK_ARGS = dict(
+    CLUSTER_ARGS, name='bench-stack',
+    nodedriver=dict(name='bench-stack', url='http://driver/stack', uiUrl='http://driver/ui'),
+    node_template=dict((key, value) for key, value in TEMPLATE_ARGS.items() if key != 'region'),
+    cluster_nodes=dict(
+        master=dict(cpu=2, memory=4, disk=20, prefix='stack-master', quantity=3, controlplane=True, etcd=True,
+                    worker=False),
+        worker=dict(cpu=2, memory=4, disk=20, prefix='stack-worker', quantity=10, controlplane=False, etcd=False,
+                    worker=True)))
+
+FLEET_ARGS = dict(user='{{ rancher_access_key }}', password='{{ rancher_secret_key }}',
+                  hosts=[dict(host='{{ rancher_host }}'), dict(host='{{ rancher_host_alias }}')])
+
+# rancher_metrics fields a budget holds per task
+BUDGET_FIELDS = ('requests', 'connections', 'bytes_sent', 'bytes_received')
+
+
+def task(module, **args):
+    return {module: dict(AUTH, **args)}
+
+
+def case(label, module, **args):
+    # the task name says what it finds and what it is asked for, budgets are kept per scenario and task name
+    return dict(task(module, **args), name=label)
+
+
+SCENARIOS = [
+    ('nodedriver', [
+        case('missing, present', 'rancher_nodedriver', name='bench', **DRIVER_ARGS),
+        case('exists, present', 'rancher_nodedriver', name='bench', **DRIVER_ARGS),
+        case('exists, info', 'rancher_nodedriver_info', name='bench', wait_for_state='active', wait_timeout=600),
+    ]),
+    ('nodetemplate', [
+        case('missing, present', 'rancher_nodetemplate', templates=TEMPLATES, **TEMPLATE_ARGS),
+        case('exists, present', 'rancher_nodetemplate', templates=TEMPLATES, **TEMPLATE_ARGS),
+    ]),
+    ('slow_post', [
+        dict(name='answer the next POST 3 seconds late', uri=dict(
+            url='{{ rancher_host }}/delay', method='POST', body_format='json',
+            body=dict(method='POST', path='/v3/nodetemplate', seconds=3, count=1))),
+        dict(case('missing, present, answered too late', 'rancher_nodetemplate', name='bench-slow', cpu=2, memory=4,
+                  disk=20, request_timeout=1, **TEMPLATE_ARGS), ignore_errors=True),
+        dict(name='look for the node template', register='slow', uri=dict(
+            url='{{ rancher_host }}/v3/nodetemplate?name=bench-slow', user='{{ rancher_access_key }}',
+            password='{{ rancher_secret_key }}', force_basic_auth=True)),
+        # the POST timed out, it must not have been sent again
+        {'name': 'created once', 'assert': dict(that=['slow.json.data | length == 1'])},
+    ]),
+    ('cluster', [
+        case('missing, present', 'rancher_cluster', name='bench-cluster', **CLUSTER_ARGS),
+        case('exists, present', 'rancher_cluster', name='bench-cluster', **CLUSTER_ARGS),
+        case('exists, wait', 'rancher_cluster_info', name='bench-cluster', wait_for_state='active', wait_timeout=600),
+    ]),
+    ('nodepool', [
+        case('missing, present', 'rancher_nodepool', cluster='bench-cluster', pools=POOLS),
+        case('exists, present', 'rancher_nodepool', cluster='bench-cluster', pools=POOLS),
+        case('exists, wait', 'rancher_node_info', cluster='bench-cluster',
+             wait_for=dict(roles=['etcd', 'controlplane'], workers=1), wait_timeout=600),
+    ]),
+    ('cluster_stack', [
+        case('missing, present', 'rancher_cluster_stack', **STACK_ARGS),
+        case('exists, present', 'rancher_cluster_stack', **STACK_ARGS),
+    ]),
+    ('cluster_info', [case('list', 'rancher_cluster_info')]),
+    ('node_info', [case('list', 'rancher_node_info', page_size=100)]),
+    ('fleet', [dict(name='list {}'.format(module), **{module: FLEET_ARGS})
+               for module in ('rancher_cluster_info', 'rancher_nodedriver_info', 'rancher_node_info')]),
+    ('clusterregistrationtoken', [
+        case('one cluster', 'rancher_clusterregistrationtoken', name='bench-cluster'),
+        case('many clusters', 'rancher_clusterregistrationtoken',
+             clusters=['bench-cluster'] + ['bench-{}'.format(i) for i in range(5)]),
+    ]),
+    ('kubeconfig', [
+        case('generate', 'rancher_kubeconfig', name='bench-cluster', dest='{{ bench_dir }}/kube_config',
+             kubeconfig_cache_path='{{ bench_dir }}/kubeconfigs'),
+        case('reuse', 'rancher_kubeconfig', name='bench-cluster', dest='{{ bench_dir }}/kube_config',
+             kubeconfig_cache_path='{{ bench_dir }}/kubeconfigs'),
+    ]),
+    ('facts', [case('download', 'rancher_facts'), case('not modified', 'rancher_facts')]),
+    ('update', [
+        case('nodedriver new checksum, present', 'rancher_nodedriver', name='bench',
+             **dict(DRIVER_ARGS, checksum='4567cdef')),
+        case('cluster new kubernetes_version, present', 'rancher_cluster', name='bench-cluster',
+             **dict(CLUSTER_ARGS, kubernetes_version='v1.16.1-rancher1-1')),
+        case('nodepool scaled, present', 'rancher_nodepool', cluster='bench-cluster',
+             pools=[dict(pool, quantity=pool['quantity'] + 2) for pool in POOLS]),
+        dict(name='expire the kubeconfig token', uri=dict(
+            url="{{ rancher_host }}/v3/tokens/{{ lookup('file', bench_dir + '/kube_config') "
+                "| regex_search('token: \"[^:]+') | regex_replace('^token: \"') }}",
+            method='PUT', body_format='json', body=dict(expired=True), user='{{ rancher_access_key }}',
+            password='{{ rancher_secret_key }}', force_basic_auth=True)),
+        dict(case('kubeconfig token expired', 'rancher_kubeconfig', name='bench-cluster',
+                  dest='{{ bench_dir }}/kube_config', kubeconfig_cache_path='{{ bench_dir }}/kubeconfigs'),
+             register='regenerated'),
+        {'name': 'not reused', 'assert': dict(that=['not regenerated.cached'])},
+    ]),
+    ('absent', [
+        case('nodepool exists, absent', 'rancher_nodepool', cluster='bench-cluster',
+             pools=[dict(pool, state='absent') for pool in POOLS]),
+        case('nodepool missing, absent', 'rancher_nodepool', cluster='bench-cluster',
+             pools=[dict(pool, state='absent') for pool in POOLS]),
+        case('nodetemplate exists, absent', 'rancher_nodetemplate',
+             templates=[dict(template, state='absent') for template in TEMPLATES], **TEMPLATE_ARGS),
+        case('nodetemplate missing, absent', 'rancher_nodetemplate',
+             templates=[dict(template, state='absent') for template in TEMPLATES], **TEMPLATE_ARGS),
+        case('cluster exists, absent', 'rancher_cluster', name='bench-cluster', state='absent', **CLUSTER_ARGS),
+        case('cluster missing, absent', 'rancher_cluster', name='bench-cluster', state='absent', **CLUSTER_ARGS),
+        case('nodedriver exists, absent', 'rancher_nodedriver', name='bench', state='absent'),
+        case('nodedriver missing, absent', 'rancher_nodedriver', name='bench', state='absent'),
+    ]),
+    ('kubernetes.yaml', os.path.join(ROOT, 'kubernetes.yaml')),
+]
+
+# the fake server of a budget run, stored with the budget when it is recorded
+BUDGET_SETTINGS = dict(latency=0.0, transition=0.0, clusters=10, nodes=500, no_gzip=False, error_rate=0.0,
+                       retry_after=None)
+
+# the variables kubernetes.yaml expects besides vars/my_k8s_cluster.yaml
+EXTRA_VARS = dict(rancher_access_key='token-bench', rancher_secret_key='secret',
+                  eportal_node_driver_url='http://driver/eportal', eportal_node_driver_ui_url='http://driver/ui',
+                  eportal_host='eportal', rancher_eportal_token='secret', vcenter_host='vcenter',
+                  rancher_vcenter_user='user', rancher_vcenter_password='password')
+
+
+def stats(base, reset=False):
+    request = urllib.request.Request(base + '/stats', method='DELETE' if reset else 'GET')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def configure(directory, action_plugins):
+    # an ansible.cfg of its own, so the repository's inventory and plugin settings don't leak in
+    path = os.path.join(directory, 'ansible.cfg')
+    with open(path, 'w') as f:
+        f.write('[defaults]\n')
+        f.write('library = {}\n'.format(os.path.join(ROOT, 'library')))
+        f.write('module_utils = {}\n'.format(os.path.join(ROOT, 'module_utils')))
+        f.write('action_plugins = {}\n'.format(os.path.join(ROOT, 'action_plugins') if action_plugins else ''))
+        f.write('localhost_warning = False\n')
+        f.write('retry_files_enabled = False\n')
+        f.write('[inventory]\ninventory_unparsed_warning = False\n')
+    return path
+
+
+def warm_up(directory):
+    # only logs in, so the measured tasks start with a bearer token but without the id cache
+    playbook = os.path.join(directory, 'warm_up.yaml')
+    with open(playbook, 'w') as f:
+        json.dump([dict(name='warm up', hosts='localhost', gather_facts=False, tasks=[
+            task('rancher_cluster_info', name='bench-warm-up')])], f, indent=2)
+    return playbook
+
+
+def run_scenario(name, scenario, base, directory, config, per_task=False):
+    if isinstance(scenario, list):
+        playbook = os.path.join(directory, '{}.yaml'.format(name.replace('.', '_')))
+        with open(playbook, 'w') as f:
+            json.dump([dict(name=name, hosts='localhost', gather_facts=False, tasks=scenario)], f, indent=2)
+        args = []
+    else:
+        playbook, args = scenario, ['--skip-tags', 'dvp']
+
+    extra_vars = os.path.join(directory, 'vars.json')
+    with open(extra_vars, 'w') as f:
+        # the fake server under a second name stands in for a second Rancher server
+        json.dump(dict(EXTRA_VARS, rancher_host=base, rancher_host_alias=base.replace('127.0.0.1', 'localhost'),
+                       bench_dir=directory), f)
+
+    env = dict(os.environ, ANSIBLE_CONFIG=config,
+               RANCHER_CACHE_PATH=os.path.join(directory, 'rancher_ids.json'),
+               RANCHER_SNAPSHOT_PATH=os.path.join(directory, 'rancher_snapshot.json'),
+               RANCHER_TOKEN_PATH=os.path.join(directory, 'rancher_tokens.json'))
+    if per_task:
+        env.update(ANSIBLE_STDOUT_CALLBACK='json')
+    command = ['ansible-playbook', '-i', 'localhost,', '-c', 'local', '-e', '@' + extra_vars]
+
+    process = subprocess.run(command + [warm_up(directory)], env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True)
+    if process.returncode:
+        return dict(scenario=name, ok=False, seconds=0.0, requests=0, connections=0, bytes_in=0, bytes_out=0,
+                    methods={}, output=process.stdout, tasks={})
+
+    # what the warm-up and earlier scenarios looked up must not spare a task its own lookups
+    for path in (env['RANCHER_CACHE_PATH'], env['RANCHER_SNAPSHOT_PATH']):
+        if os.path.exists(path):
+            os.remove(path)
+
+    stats(base, reset=True)
+    started = time.time()
+    process = subprocess.run(command + args + [playbook], env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True)
+    elapsed = time.time() - started
+    counters = stats(base)
+
+    return dict(scenario=name, ok=process.returncode == 0, seconds=round(elapsed, 3),
+                requests=counters['requests'], connections=counters['connections'],
+                bytes_in=counters['bytes_in'], bytes_out=counters['bytes_out'],
+                methods=counters['methods'], output=process.stdout if process.returncode else None,
+                tasks=task_metrics(name, process.stdout) if per_task else None)
+
+
+def task_metrics(scenario, output):
+    # '<scenario>: <task name>' -> the budget fields of its rancher_metrics
+    lines = output.splitlines()
+    if '{' not in lines:
+        return {}
+    tasks = {}
+    for play in json.loads('\n'.join(lines[lines.index('{'):]))['plays']:
+        for entry in play['tasks']:
+            for result in entry['hosts'].values():
+                # a loop's items carry the metrics, batch modules return results of their own next to them
+                items = [result] if 'rancher_metrics' in result else result.get('results', [])
+                metrics = [item['rancher_metrics'] for item in items if 'rancher_metrics' in item]
+                if not metrics:
+                    continue
+                key = '{}: {}'.format(scenario, entry['task']['name'])
+                count = len([other for other in tasks if other == key or other.startswith(key + ' #')])
+                if count:
+                    key = '{} #{}'.format(key, count + 1)
+                tasks[key] = dict((field, sum(item[field] for item in metrics)) for field in BUDGET_FIELDS)
+                tasks[key]['concurrency'] = sum(item.get('concurrency', 1) for item in metrics)
+                tasks[key]['parallel'] = any(item.get('concurrency', 1) > 1 for item in metrics)
+    return tasks
+
+
+def check_budget(results, budget, bytes_tolerance):
+    # Requests and bytes sent are fixed by the scenario and have to match the budget exactly, in both
+    # directions.  Bytes received may be off by the tolerance: the bodies carry timestamps and ids of a fixed
+    # width, but how well gzip compresses them varies a little.  Without a tolerance bytes aren't checked,
+    # what a listing returns depends on the scenarios that ran before.  A task that sends one request at a
+    # time opens exactly the connections of its budget.  One with requests in parallel only opens a
+    # connection while all the open ones are busy, so it may not open more than the requests it had in
+    # flight at once (its concurrency); how many that are depends on timing.  Tasks without a budget, and
+    # budgeted tasks of a scenario that ran without them, fail too
+    problems = []
+    for result in results:
+        tasks = result['tasks'] or {}
+        for key, used in sorted(tasks.items()):
+            allowed = budget['tasks'].get(key)
+            if allowed is None:
+                problems.append('{}: no budget, record one with --record-budget'.format(key))
+                continue
+            for field in BUDGET_FIELDS:
+                if field.startswith('bytes') and bytes_tolerance is None:
+                    continue
+                if field == 'bytes_received':
+                    ok = abs(used[field] - allowed[field]) <= allowed[field] * bytes_tolerance
+                elif field == 'connections' and (used['parallel'] or allowed.get('parallel')):
+                    if used[field] > used['concurrency']:
+                        problems.append('{}: {} connections for {} requests in flight at once'.format(
+                            key, used[field], used['concurrency']))
+                    continue
+                else:
+                    ok = used[field] == allowed[field]
+                if not ok:
+                    problems.append('{}: {} {}, the budget has {}'.format(key, used[field], field, allowed[field]))
+        prefix = '{}: '.format(result['scenario'])
+        for key in sorted(key for key in budget['tasks'] if key.startswith(prefix) and key not in tasks):
+            problems.append('{}: did not run, the budget has {} requests'.format(key, budget['tasks'][key]['requests']))
+    return problems
+
+
+def record_budget(runs):
+    # the runs have to agree on everything check_budget() holds exactly, bytes received keep the most any
+    # run took.  A task that sent requests in parallel in any run is marked, it may run them one at a time
+    # in another
+    tasks, problems = {}, []
+    for key in sorted(set(key for run in runs for result in run for key in result['tasks'])):
+        used = [result['tasks'][key] for run in runs for result in run if key in result['tasks']]
+        parallel = any(item['parallel'] for item in used)
+        for field in ('requests', 'bytes_sent') if parallel else ('requests', 'connections', 'bytes_sent'):
+            if len(set(item[field] for item in used)) > 1:
+                problems.append('{}: {} {} in different runs'.format(
+                    key, ', '.join(str(item[field]) for item in used), field))
+        tasks[key] = dict((field, max(item[field] for item in used)) for field in BUDGET_FIELDS)
+        if parallel:
+            tasks[key]['parallel'] = True
+    return tasks, problems
+
+
+def report(results):
+    print('{:<26} {:>4} {:>9} {:>9} {:>11} {:>10} {:>11}'.format(
+        'scenario', 'ok', 'seconds', 'requests', 'connections', 'bytes in', 'bytes out'))
+    for result in results:
+        print('{:<26} {:>4} {:>9.3f} {:>9} {:>11} {:>10} {:>11}'.format(
+            result['scenario'], 'yes' if result['ok'] else 'NO', result['seconds'], result['requests'],
+            result['connections'], result['bytes_in'], result['bytes_out']))
+    for result in results:
+        if result['output']:
+            print('\n--- {} failed ---\n{}'.format(result['scenario'], result['output'][-4000:]))
+
+
+def run_all(args, per_task=False):
+    server, base = fake_rancher.serve(latency=args.latency, transition=args.transition, compress=not args.no_gzip,
+                                      clusters=args.clusters, nodes=args.nodes, error_rate=args.error_rate,
+                                      retry_after=args.retry_after)
+    directory = tempfile.mkdtemp(prefix='rancher-bench-')
+    config = configure(directory, args.action_plugins)
+
+    try:
+        return [run_scenario(name, scenario, base, directory, config, per_task=per_task)
+                for name, scenario in SCENARIOS if not args.scenarios or name in args.scenarios]
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Rancher modules against a fake Rancher')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all by default: {}'.format(
+        ', '.join(name for name, scenario in SCENARIOS)))
+    parser.add_argument('--action-plugins', action='store_true', help='run the modules in-process')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--transition', type=float, default=1.0, help='seconds until new objects are active')
+    parser.add_argument('--clusters', type=int, default=10, help='clusters to start with')
+    parser.add_argument('--nodes', type=int, default=500, help='nodes to start with')
+    parser.add_argument('--no-gzip', action='store_true')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 503')
+    parser.add_argument('--retry-after', type=int, help='Retry-After seconds sent with the 503s')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--budget',
+                        help='fail when a task takes other requests, connections or bytes than in this file')
+    parser.add_argument('--record-budget', help='write the requests, connections and bytes of every task to this file')
+    parser.add_argument('--bytes-tolerance', type=float, default=0.02,
+                        help='share of bytes received a task may differ from its budget by')
+    parser.add_argument('--record-runs', type=int, default=3,
+                        help='runs a budget is recorded from, they have to agree on requests, connections and bytes '
+                             'sent')
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(name for name, scenario in SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    budget = None
+    if args.budget:
+        with open(args.budget) as f:
+            budget = json.load(f)
+    if budget or args.record_budget:
+        for key, value in (budget['settings'] if budget else BUDGET_SETTINGS).items():
+            setattr(args, key, value)
+
+    # a budget is recorded from several runs, to catch tasks that don't take the same every time
+    runs = [run_all(args, per_task=bool(budget or args.record_budget))
+            for run in range(max(args.record_runs, 1) if args.record_budget else 1)]
+    results = runs[-1]
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(settings=vars(args), results=results), f, indent=2)
+
+    ok = all(result['ok'] for run in runs for result in run)
+    if args.record_budget and ok:
+        tasks, problems = record_budget(runs)
+        for line in problems:
+            print('NOT RECORDED {}'.format(line))
+        ok = not problems
+    if args.record_budget and ok:
+        with open(args.record_budget, 'w') as f:
+            json.dump(dict(settings=dict((key, getattr(args, key)) for key in BUDGET_SETTINGS), tasks=tasks), f,
+                      indent=2, sort_keys=True)
+            f.write('\n')
+        print('\nrecorded the budget of {} tasks in {}'.format(len(tasks), args.record_budget))
+
+    if budget:
+        problems = check_budget(results, budget, None if args.scenarios else args.bytes_tolerance)
+        if args.scenarios:
+            print('\nbytes are only held to the budget when all scenarios run')
+        for line in problems:
+            print('OFF BUDGET {}'.format(line))
+        ok = ok and not problems
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
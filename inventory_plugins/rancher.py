@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: rancher
+    plugin_type: inventory
+    short_description: Rancher clusters, node pools and nodes
+    description:
+        - Reads clusters, node pools and nodes from the Rancher v3 API used by the rancher_* modules.
+        - Clusters and node pools become groups, nodes become hosts with their states and roles as variables.
+        - The three collections are fetched concurrently over one pooled connection.
+        - Uses a YAML configuration file that ends with C(rancher.yml) or C(rancher.yaml).
+    extends_documentation_fragment:
+        - constructed
+        - inventory_cache
+    options:
+        plugin:
+            description: The name of this plugin, it should always be set to C(rancher).
+            required: true
+            choices: ['rancher']
+        host:
+            description: The Rancher server, optionally with a scheme.
+            required: true
+            env:
+                - name: RANCHER_HOST
+        user:
+            description: The Rancher API access key.
+            required: true
+            env:
+                - name: RANCHER_ACCESS_KEY
+        password:
+            description: The Rancher API secret key.
+            required: true
+            env:
+                - name: RANCHER_SECRET_KEY
+        clusters:
+            description: Only include these clusters (by name), all clusters when empty.
+            type: list
+            default: []
+'''
+
+EXAMPLES = '''
+# inventory/rancher.yml
+plugin: rancher
+host: rancher.example.com
+clusters:
+  - pauls-test-1016
+cache: yes
+cache_plugin: jsonfile
+cache_connection: ~/.ansible/tmp/rancher_inventory
+cache_timeout: 600
+'''
+
+import os
+import re
+
+from ansible.errors import AnsibleError
+from ansible.module_utils._text import to_native
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
+
+try:
+    from importlib.util import module_from_spec, spec_from_file_location
+except ImportError:
+    module_from_spec = spec_from_file_location = None
+
+
+# the same fields the modules return by default, plus what the inventory needs
+CLUSTER_FIELDS = ['id', 'name', 'state', 'transitioning']
+NODEPOOL_FIELDS = ['id', 'name', 'state', 'clusterId', 'nodeTemplateId', 'quantity', 'controlPlane', 'etcd', 'worker']
+NODE_FIELDS = ['id', 'state', 'clusterId', 'nodePoolId', 'hostname', 'nodeName', 'requestedHostname',
+               'ipAddress', 'externalIpAddress', 'controlPlane', 'etcd', 'worker', 'labels']
+
+
+def load_rancher_utils():
+    # module_utils/ next to the playbooks is only importable by modules, load the client by path
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils', 'rancher.py')
+    if spec_from_file_location is None:
+        raise AnsibleError("The rancher inventory plugin requires Python 3.")
+    spec = spec_from_file_location('ansible.module_utils.rancher', path)
+    rancher = module_from_spec(spec)
+    spec.loader.exec_module(rancher)
+    return rancher
+
+
+class RancherOptions(object):
+
+    # stands in for AnsibleModule, RancherClient only reads params
+    def __init__(self, **params):
+        self.params = params
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+
+    NAME = 'rancher'
+
+    def verify_file(self, path):
+        return super(InventoryModule, self).verify_file(path) and path.endswith(('rancher.yml', 'rancher.yaml'))
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path)
+        self._read_config_data(path)
+
+        cache_key = self.get_cache_key(path)
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        results = None
+        if attempt_to_read_cache:
+            try:
+                results = self._cache[cache_key]
+            except KeyError:
+                cache_needs_update = True
+
+        if results is None:
+            results = self._fetch()
+
+        if cache_needs_update:
+            self._cache[cache_key] = results
+
+        self._populate(results)
+
+    def _fetch(self):
+        rancher = load_rancher_utils()
+        client = rancher.RancherClient(RancherOptions(
+            host=self.get_option('host'),
+            user=self.get_option('user'),
+            password=self.get_option('password'),
+        ))
+
+        collections = [('cluster', CLUSTER_FIELDS), ('nodepool', NODEPOOL_FIELDS), ('node', NODE_FIELDS)]
+
+        def fetch(collection):
+            kind, fields = collection
+            return [rancher.project(item, fields) for item in client.iter_collection('/v3/{}'.format(kind))]
+
+        try:
+            clusters, nodepools, nodes = rancher.run_concurrently(fetch, collections, len(collections))
+        except Exception as e:
+            raise AnsibleError("Failed to read the Rancher inventory from {}: {}".format(
+                self.get_option('host'), to_native(e)))
+        finally:
+            client.close()
+
+        return dict(clusters=clusters, nodepools=nodepools, nodes=nodes)
+
+    def _populate(self, results):
+        wanted = self.get_option('clusters')
+        clusters = dict((cluster['id'], cluster) for cluster in results['clusters']
+                        if not wanted or cluster['name'] in wanted)
+        nodepools = dict((pool['id'], pool) for pool in results['nodepools'] if pool.get('clusterId') in clusters)
+        strict = self.get_option('strict')
+
+        for cluster in clusters.values():
+            group = self.inventory.add_group(self._group_name('cluster', cluster['name']))
+            self.inventory.set_variable(group, 'rancher_cluster_id', cluster['id'])
+            self.inventory.set_variable(group, 'rancher_cluster_state', cluster.get('state'))
+
+        # pool names are only unique within a cluster, so are their groups
+        pool_groups = dict((pool['id'], self._group_name('nodepool', '{}_{}'.format(
+            clusters[pool['clusterId']]['name'], pool['name']))) for pool in nodepools.values())
+
+        for pool in nodepools.values():
+            group = self.inventory.add_group(pool_groups[pool['id']])
+            self.inventory.add_child(self._group_name('cluster', clusters[pool['clusterId']]['name']), group)
+            self.inventory.set_variable(group, 'rancher_nodepool_id', pool['id'])
+            self.inventory.set_variable(group, 'rancher_nodepool_quantity', pool.get('quantity'))
+
+        for node in results['nodes']:
+            cluster = clusters.get(node.get('clusterId'))
+            if not cluster:
+                continue
+
+            hostname = node.get('nodeName') or node.get('hostname') or node.get('requestedHostname') or node['id']
+            roles = [role for role, key in (('etcd', 'etcd'), ('controlplane', 'controlPlane'), ('worker', 'worker'))
+                     if node.get(key)]
+
+            pool = nodepools.get(node.get('nodePoolId'))
+            group = pool_groups[pool['id']] if pool else self._group_name('cluster', cluster['name'])
+            self.inventory.add_host(hostname, group=group)
+
+            hostvars = dict(
+                rancher_node_id=node['id'],
+                rancher_node_state=node.get('state'),
+                rancher_node_roles=roles,
+                rancher_node_labels=node.get('labels') or {},
+                rancher_cluster=cluster['name'],
+                rancher_nodepool=pool['name'] if pool else None,
+            )
+            if node.get('ipAddress') or node.get('externalIpAddress'):
+                hostvars['ansible_host'] = node.get('externalIpAddress') or node.get('ipAddress')
+            for key, value in hostvars.items():
+                self.inventory.set_variable(hostname, key, value)
+
+            for role in roles:
+                self.inventory.add_child(self.inventory.add_group('rancher_' + role), hostname)
+
+            self._set_composite_vars(self.get_option('compose'), hostvars, hostname, strict=strict)
+            self._add_host_to_composed_groups(self.get_option('groups'), hostvars, hostname, strict=strict)
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), hostvars, hostname, strict=strict)
+
+    @staticmethod
+    def _group_name(prefix, name):
+        return re.sub(r'[^A-Za-z0-9_]', '_', '{}_{}'.format(prefix, name))
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.rancher import (RancherClient, cluster_apply, error_message, find, nodedriver_apply,
+                                          pool_apply, rancher_argument_spec, run_graph, template_data)
+
+
+RETURN_FIELDS = ('clusterId', 'nodeTemplateId', 'quantity', 'active')
+
+
+class StepFailed(Exception):
+    pass
+
+
+def main():
+
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(
+
+        name=dict(type='str', required=True),  # the cluster, node templates and pools are named <name>-<node type>
+        region=dict(type='str', required=True),
+        host=dict(type='str', required=True),
+        user=dict(type='str', required=True),
+        password=dict(type='str', required=True, no_log=True),
+
+        # the cluster, as for rancher_cluster
+        kubernetes_version=dict(type='str', required=True),
+        cni_provider=dict(type='str', required=True),
+        ingress_provider=dict(type='str', required=True),
+        enable_dvp=dict(type='bool', required=True),
+        vcenter_host=dict(type='str', required=False),
+        vcenter_user=dict(type='str', required=False),
+        vcenter_password=dict(type='str', required=False, no_log=True),
+        vcenter_machine_folder=dict(type='str', required=False),
+        vcenter_datastore=dict(type='str', required=False),
+
+        # cluster_nodes from vars/my_k8s_cluster.yaml, one node template and node pool per node type
+        cluster_nodes=dict(type='dict', required=True),
+
+        # settings shared by all node templates, as for rancher_nodetemplate
+        node_template=dict(type='dict', required=True, options=dict(
+            server=dict(type='str', required=True),
+            token=dict(type='str', required=True, no_log=True),
+            network=dict(type='str', required=True),
+            ssh_user=dict(type='str', required=False),
+            image=dict(type='str', required=True),
+            engine_install_url=dict(type='str', required=True),
+            engine_storage_driver=dict(type='str', required=True),
+            engine_options=dict(type='dict', required=True),
+        )),
+
+        # the node driver the templates use, installed and waited for first when given
+        nodedriver=dict(type='dict', required=False, options=dict(
+            name=dict(type='str', required=True),
+            url=dict(type='str', required=False),
+            uiUrl=dict(type='str', required=False),
+            checksum=dict(type='str', required=False),
+            whitelist_domains=dict(type='list', elements='str', required=False),
+            wait_timeout=dict(type='int', required=False, default=60),
+        )),
+
+        parallelism=dict(type='int', required=False, default=8),
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=False
+    )
+
+    specs = node_specs(module)
+    client = RancherClient(module)
+
+    steps = graph(module, client, specs)
+    done = run_graph(steps, module.params.get('parallelism'))
+
+    report = []
+    for name, step in sorted(done.items(), key=lambda item: (item[1]['start'], item[0])):
+        entry = dict(name=name, start=step['start'], seconds=step['seconds'], depends=steps[name][1])
+        if step.get('skipped'):
+            entry.update(skipped=True)
+        elif 'error' in step:
+            entry.update(failed=True, msg=error_message(step['error']))
+        else:
+            entry.update(changed=step['result'].get('changed', False))
+            entry.update((key, value) for key, value in step['result'].items() if key in ('status', 'changes'))
+        report.append(entry)
+
+    changed = any(entry.get('changed') for entry in report)
+    elapsed = max([step['start'] + step['seconds'] for step in done.values()] or [0])
+    result = dict(changed=changed, steps=report, elapsed=round(elapsed, 3),
+                  steps_seconds=round(sum(step['seconds'] for step in done.values()), 3))
+
+    if 'cluster' in done and 'result' in done['cluster']:
+        result['resource'] = client.project(done['cluster']['result']['resource'])
+    result['nodepools'] = [client.project(done[name]['result']['resource'], *RETURN_FIELDS)
+                           for name in sorted(done) if name.startswith('nodepool ') and 'result' in done[name]]
+
+    failed = [entry['name'] for entry in report if entry.get('failed') or entry.get('skipped')]
+    if failed:
+        module.fail_json(msg="Failed to provision the cluster stack: {}".format(", ".join(failed)), **result)
+    module.exit_json(**result)
+
+
+def node_specs(module):
+    specs = []
+    for node_type, node in sorted(module.params.get('cluster_nodes').items()):
+        missing = [key for key in ('cpu', 'memory', 'disk', 'prefix', 'quantity', 'controlplane', 'etcd', 'worker')
+                   if node.get(key) is None]
+        if missing:
+            module.fail_json(msg="missing required arguments for node type {}: {}".format(
+                node_type, ", ".join(missing)))
+        specs.append(dict(node, name='{}-{}'.format(module.params.get('name'), node_type)))
+    return specs
+
+
+def graph(module, client, specs):
+    # step name -> (function, dependencies), every function takes the results of the finished steps
+    driver = module.params.get('nodedriver')
+    names = [spec['name'] for spec in specs]
+    steps = {
+        'cluster': (lambda results: cluster_it(module, client), []),
+        'nodetemplates': (lambda results: existing_it(client, '/v3/nodetemplate', names), []),
+        'nodepools': (lambda results: existing_it(client, '/v3/nodepool', names,
+                                                  {'clusterId': results['cluster']['resource']['id']}), ['cluster']),
+    }
+
+    template_dependencies = ['nodetemplates']
+    if driver:
+        steps['nodedriver'] = (lambda results: nodedriver_it(client, driver), [])
+        steps['nodedriver active'] = (lambda results: nodedriver_wait(client, driver, results['nodedriver']),
+                                      ['nodedriver'])
+        template_dependencies.append('nodedriver active')
+
+    for spec in specs:
+        steps['nodetemplate {}'.format(spec['name'])] = (
+            lambda results, spec=spec: template_it(module, client, spec, results['nodetemplates']),
+            template_dependencies)
+        steps['nodepool {}'.format(spec['name'])] = (
+            lambda results, spec=spec: pool_it(client, spec, results),
+            ['cluster', 'nodepools', 'nodetemplate {}'.format(spec['name'])])
+    return steps
+
+
+def existing_it(client, url, names, params=None):
+    return dict((item['name'], item) for item in client.iter_collection(url, params=params, match={'name': names}))
+
+
+def nodedriver_it(client, driver):
+    return nodedriver_apply(client, driver, find(client, 'nodedriver', driver['name'])[0])
+
+
+def nodedriver_wait(client, driver, step):
+    if not step['changed'] and step['resource'].get('state') == "active":
+        return dict(changed=False, resource=step['resource'])
+    item, timing = client.wait_for_state('nodedriver', driver['name'], 'active', driver['wait_timeout'])
+    if not timing['reached']:
+        raise StepFailed("Timed out waiting for the node driver {} to become active, it is {}.".format(
+            driver['name'], item.get('state') if item else 'missing'))
+    return dict(changed=False, resource=item)
+
+
+def cluster_it(module, client):
+    cluster, result = find(client, 'cluster', module.params.get('name'))
+    if cluster:
+        client.remember('cluster', [cluster])
+    return cluster_apply(client, module.params, cluster, result.from_snapshot)
+
+
+def template_it(module, client, spec, existing):
+    if spec['name'] in existing:
+        return dict(changed=False, resource=existing[spec['name']])
+    data = dict(module.params.get('node_template'), region=module.params.get('region'))
+    data.update(spec)
+    result = client.post('/v3/nodetemplate', data=template_data(data))
+    resource = result.json()
+    client.remember('nodetemplate', [resource])
+    return dict(changed=True, resource=resource, status=result.status)
+
+
+def pool_it(client, spec, results):
+    return pool_apply(client, spec, results['cluster']['resource']['id'],
+                      results['nodetemplate {}'.format(spec['name'])]['resource']['id'],
+                      results['nodepools'].get(spec['name']))
+
+
+if __name__ == '__main__':
+    main()
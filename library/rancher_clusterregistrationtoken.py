@@ -1,67 +1,117 @@
 #!/usr/bin/python
 
 from ansible.module_utils.basic import AnsibleModule, json
-from ansible.module_utils.urls import open_url, urllib_request
+from ansible.module_utils.rancher import RancherClient, rancher_argument_spec, run_concurrently
+from ansible.module_utils.urls import urllib_request
+
+
+RETURN_FIELDS = ('clusterId', 'command', 'nodeCommand', 'insecureCommand', 'windowsNodeCommand', 'manifestUrl')
+
+COMMAND_FIELDS = ['nodeCommand', 'command', 'insecureCommand', 'windowsNodeCommand', 'manifestUrl']
 
 
 def main():
 
-    argument_spec = dict(
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(
 
-        name=dict(type='str', required=True),
+        name=dict(type='str', required=False),
         host=dict(type='str', required=True),
         user=dict(type='str', required=True),
         password=dict(type='str', required=True, no_log=True),
+
+        # many clusters at once (names or ids), returned as a cluster -> command map
+        clusters=dict(type='list', elements='str', required=False),
+        command_field=dict(type='str', required=False, default='nodeCommand', choices=COMMAND_FIELDS),
+        create_missing=dict(type='bool', required=False, default=True),  # create tokens for clusters without one
+        parallelism=dict(type='int', required=False, default=4),
     )
 
     module = AnsibleModule(
         argument_spec=argument_spec,
+        required_one_of=[['name', 'clusters']],
+        mutually_exclusive=[['name', 'clusters']],
         supports_check_mode=False
     )
 
+    client = RancherClient(module)
+
     try:
-        # Get the cluster object id
-        result = open_url(
-            url="https://{}/v3/cluster?name={}".format(
-                module.params.get("host"),
-                module.params.get("name")
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='GET',
-        )
-        cluster_resource = json.loads(result.read())
-
-        # get the cluster id
-        cluster_id = cluster_resource['data'][0]['id']
-
-        result = open_url(
-            url="https://{}/v3/clusterregistrationtoken?clusterId={}".format(
-                module.params.get("host"),
-                cluster_id
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='GET',
-        )
-        crt_resource = json.loads(result.read())
-        module.exit_json(changed=False, resource=crt_resource, status=result.status, reason=result.reason)
+        names = module.params.get('clusters') or [module.params.get('name')]
+
+        # Get the cluster object ids
+        clusters = resolve_clusters(client, names)
+        missing = [name for name in names if name not in clusters]
+        if missing:
+            module.fail_json(msg="The cluster {} does not exist.".format(', '.join(missing)))
+
+        cluster_ids = sorted(set(cluster['id'] for cluster in clusters.values()))
+        tokens, created = read_tokens(module, client, cluster_ids)
+
+        field = module.params.get('command_field')
+        commands = dict((name, tokens[cluster['id']].get(field) if cluster['id'] in tokens else None)
+                        for name, cluster in clusters.items())
+
+        data = [client.project(tokens[cluster_id], *RETURN_FIELDS) for cluster_id in cluster_ids
+                if cluster_id in tokens]
+        module.exit_json(changed=bool(created), created=created, commands=commands,
+                         resource=dict(type='collection', data=data))
 
     except urllib_request.HTTPError as e:
         module.fail_json(msg=json.loads(e.fp.read()))
 
 
+def resolve_clusters(client, names):
+    # cached names first, then one name query for a single cluster or one read of the collection for many
+    clusters = {}
+    for name in names:
+        entry = client.cache.get(client.base_url, 'cluster', name)
+        if entry:
+            clusters[name] = entry
+
+    # Rancher ANDs repeated query parameters, so several names can't go into one ?name= filter
+    wanted = [name for name in names if name not in clusters]
+    if len(wanted) == 1:
+        for params in ({'name': wanted[0], 'limit': 1}, {'id': wanted[0], 'limit': 1}):
+            items = list(client.query('cluster', params).iter_items())
+            if items:
+                clusters[wanted[0]] = items[0]
+                break
+    elif wanted:
+        for item in client.iter_collection('/v3/cluster'):
+            for key in (item.get('name'), item.get('id')):
+                if key in wanted and key not in clusters:
+                    clusters[key] = item
+
+    client.remember('cluster', [cluster for name, cluster in clusters.items()
+                                if name in wanted and name == cluster.get('name')])
+    return clusters
+
+
+def read_tokens(module, client, cluster_ids):
+    # the first token of every cluster, one request for all of them, missing ones are created concurrently
+    params = {'clusterId': cluster_ids[0]} if len(cluster_ids) == 1 else None
+    tokens = {}
+    for token in client.iter_collection('/v3/clusterregistrationtoken', params=params,
+                                        match={'clusterId': cluster_ids}):
+        tokens.setdefault(token['clusterId'], token)
+
+    missing = [cluster_id for cluster_id in cluster_ids if cluster_id not in tokens]
+    if not missing or not module.params.get('create_missing'):
+        return tokens, []
+
+    def create(cluster_id):
+        token = client.post('/v3/clusterregistrationtoken', data={'type': 'clusterRegistrationToken',
+                                                                  'clusterId': cluster_id}).json()
+        # Rancher may fill in the commands only after the token was created
+        if not token.get(module.params.get('command_field')) and token.get('links', {}).get('self'):
+            token = client.get(token['links']['self']).json()
+        return token
+
+    for token in run_concurrently(create, missing, module.params.get('parallelism')):
+        tokens[token['clusterId']] = token
+    return tokens, missing
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+import time
+
+from ansible.module_utils.basic import AnsibleModule, json
+from ansible.module_utils.rancher import RancherClient, rancher_argument_spec, run_concurrently
+from ansible.module_utils.urls import urllib_request
+
+
+COLLECTIONS = ['cluster', 'nodepool', 'nodetemplate', 'nodedriver', 'clusterregistrationtoken']
+
+RETURN_FIELDS = ('clusterId', 'nodeTemplateId', 'quantity', 'active')
+
+
+def main():
+
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(
+
+        host=dict(type='str', required=True),
+        user=dict(type='str', required=True),
+        password=dict(type='str', required=True, no_log=True),
+
+        collections=dict(type='list', elements='str', required=False, default=COLLECTIONS),
+        snapshot_path=dict(type='str', required=False),  # default: ~/.ansible/tmp/rancher_snapshot.json or RANCHER_SNAPSHOT_PATH
+        force=dict(type='bool', required=False, default=False),  # download everything, even if the server says unchanged
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    client = RancherClient(module)
+
+    try:
+        kinds = module.params.get('collections')
+        entries = dict(run_concurrently(lambda kind: refresh_it(module, client, kind), kinds, len(kinds)))
+
+        client.snapshot.save(entries)
+        # node pools are left out, their names are only unique within a cluster
+        for kind in ('cluster', 'nodetemplate', 'nodedriver'):
+            if kind in entries:
+                client.remember(kind, entries[kind]['data'])
+
+        snapshot = dict(host=client.base_url, collections=dict(
+            (kind, dict(
+                revision=entry.get('revision'),
+                fetched=entry['fetched'],
+                modified=entry['modified'],
+                count=len(entry['data']),
+                data=[client.project(item, *RETURN_FIELDS) for item in entry['data']],
+            )) for kind, entry in entries.items()))
+
+        module.exit_json(changed=False, ansible_facts=dict(rancher_snapshot=snapshot))
+
+    except urllib_request.HTTPError as e:
+        module.fail_json(msg=json.loads(e.fp.read()))
+
+
+def refresh_it(module, client, kind):
+    # one request per collection, answered with 304 Not Modified when the stored ETag still matches
+    entry = client.snapshot.entry(kind)
+    headers = None
+    if entry and entry.get('etag') and not module.params.get('force'):
+        headers = {'If-None-Match': entry['etag']}
+
+    result = client.get('/v3/{}'.format(kind), params={'limit': -1}, headers=headers)
+    if result.status == 304:
+        return kind, dict(entry, fetched=time.time(), modified=False)
+
+    resource = result.json()
+    return kind, dict(
+        fetched=time.time(),
+        modified=True,
+        etag=result.headers.get('ETag'),
+        revision=resource.get('revision'),
+        data=resource.get('data') or [],
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,37 @@
 #!/usr/bin/python
 
+import calendar
+import hashlib
+import os
+import re
+import tempfile
+import time
+
 from ansible.module_utils.basic import AnsibleModule, json
-from ansible.module_utils.urls import open_url, urllib_request
+from ansible.module_utils.rancher import RancherClient, rancher_argument_spec
+from ansible.module_utils.six.moves.urllib.parse import urlsplit
+from ansible.module_utils.urls import urllib_request
+
+
+DEFAULT_KUBECONFIG_CACHE_PATH = '~/.ansible/tmp/rancher_kubeconfigs'
+
+TOKEN_PATTERN = re.compile(r'^\s*token:\s*"?([^"\s]+)"?\s*$', re.MULTILINE)
 
 
 def main():
 
-    argument_spec = dict(
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(
 
         name=dict(type='str', required=True),
         host=dict(type='str', required=True),
         user=dict(type='str', required=True),
         password=dict(type='str', required=True, no_log=True),
+
+        dest=dict(type='path', required=False),  # write the kubeconfig (0600) here instead of returning it
+        reuse=dict(type='bool', required=False, default=True),  # reuse the last kubeconfig while its token is valid
+        kubeconfig_cache_path=dict(type='path', required=False, default=DEFAULT_KUBECONFIG_CACHE_PATH),
+        min_validity=dict(type='int', required=False, default=3600),  # seconds the reused token must still be valid
     )
 
     module = AnsibleModule(
@@ -23,53 +43,125 @@ def main():
     if state not in ['present', 'absent']:
         module.fail_json(msg="The state specified may only be either 'present' or 'absent'.")
 
+    client = RancherClient(module)
+
     try:
-        # Get the cluster object id
-        result = open_url(
-            url="https://{}/v3/cluster?name={}".format(
-                module.params.get("host"),
-                module.params.get("name")
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='GET',
-        )
-        resource = json.loads(result.read())
-        cluster_id = resource.get('data')[0].get('id')
-        state = resource.get('data')[0].get('state')
-
-        if state != "active":
+        # Get the cluster object id, cached lookups carry no state and leave the check to generateKubeconfig
+        cluster = client.resolve('cluster', module.params.get('name'))
+        if not cluster:
+            module.fail_json(msg="The cluster {} does not exist.".format(module.params.get('name')))
+        cluster_id = cluster.get('id')
+        state = cluster.get('state', "active")
+
+        # Rancher serves the cluster while it adds or removes nodes
+        if state not in ("active", "updating"):
             module.fail_json(msg="The cluster state is not active, but {}.".format(state))
 
-        # Generate the kubeconfig
-        post_result = open_url(
-            url="https://{}/v3/cluster/{}?action=generateKubeconfig".format(
-                module.params.get("host"),
-                cluster_id
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='POST',
-        )
-        kubeconfig_resource = json.loads(post_result.read())
-        module.exit_json(changed=False, resource=kubeconfig_resource, status=result.status, reason=result.reason)
+        # per API key like the bearer tokens, another key (or a new secret) must not get this key's kubeconfig
+        key = hashlib.sha256(client.tokens.key.encode('utf-8')).hexdigest()[:16]
+        cache_file = os.path.join(os.path.expanduser(module.params.get('kubeconfig_cache_path')),
+                                  '{}_{}_{}.json'.format(urlsplit(client.base_url).netloc.replace(':', '_'), key,
+                                                         cluster_id))
+
+        cached = read_cache(cache_file) if module.params.get('reuse') else None
+        if cached and not token_valid(module, client, cached):
+            cached = None
+
+        if cached:
+            entry, status, reason = cached, 200, 'OK (cached)'
+        else:
+            # Generate the kubeconfig, this creates a new token in Rancher
+            post_result = client.post('/v3/cluster/{}'.format(cluster_id), params={'action': 'generateKubeconfig'})
+            kubeconfig_resource = json.loads(post_result.read())
+            entry = dict(config=kubeconfig_resource.get('config'), cluster_id=cluster_id,
+                         token=token_name(kubeconfig_resource.get('config')))
+            entry['expires'] = token_expiry(client, entry['token'])
+            status, reason = post_result.status, post_result.reason
+            if module.params.get('reuse'):
+                write_private(cache_file, json.dumps(entry))
+
+        result = dict(cached=bool(cached), expires=entry.get('expires'), status=status, reason=reason)
+
+        if module.params.get('dest'):
+            changed = write_dest(module.params.get('dest'), entry['config'])
+            module.exit_json(changed=changed, dest=module.params.get('dest'), **result)
+
+        module.exit_json(changed=False, resource=dict(config=entry['config']), **result)
 
     except urllib_request.HTTPError as e:
         module.fail_json(msg=json.loads(e.fp.read()))
 
 
+def token_name(config):
+    # kubeconfig-user-xxxxx.c-xxxxx:secret -> kubeconfig-user-xxxxx.c-xxxxx
+    match = TOKEN_PATTERN.search(config or '')
+    return match.group(1).split(':')[0] if match else None
+
+
+def token_expiry(client, name):
+    # epoch seconds, None for tokens that do not expire (or can't be read)
+    if not name:
+        return None
+    try:
+        token = client.get('/v3/tokens/{}'.format(name)).json()
+    except urllib_request.HTTPError:
+        return None
+    if not token.get('expiresAt'):
+        return None
+    return calendar.timegm(time.strptime(token['expiresAt'], '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def token_valid(module, client, entry):
+    if entry.get('expires') and entry['expires'] < time.time() + module.params.get('min_validity'):
+        return False
+    if not entry.get('token'):
+        return True
+
+    # one GET instead of a new token, the token may have been deleted or expired early
+    try:
+        token = client.get('/v3/tokens/{}'.format(entry['token'])).json()
+    except urllib_request.HTTPError as e:
+        if e.code in (401, 403, 404):
+            return False
+        raise
+    return not token.get('expired') and token.get('enabled', True)
+
+
+def read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_private(path, content):
+    # the kubeconfig holds a cluster admin token, never let it be readable by others
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.rancher_kubeconfig')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0o600)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def write_dest(dest, config):
+    dest = os.path.expanduser(dest)
+    try:
+        with open(dest) as f:
+            if f.read() == config:
+                os.chmod(dest, 0o600)
+                return False
+    except (IOError, OSError):
+        pass
+    write_private(dest, config)
+    return True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+import time
+
+from ansible.module_utils.basic import AnsibleModule, json
+from ansible.module_utils.rancher import RancherClient, fleet_argument_spec, list_objects, rancher_argument_spec
+from ansible.module_utils.urls import urllib_request
+
+
+RETURN_FIELDS = ('clusterId', 'nodePoolId', 'nodeName', 'hostname', 'ipAddress', 'controlPlane', 'etcd', 'worker')
+
+# node pool flag -> role name used in progress and wait_for
+ROLES = (('etcd', 'etcd'), ('controlPlane', 'controlplane'), ('worker', 'worker'))
+
+
+def main():
+
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(fleet_argument_spec())
+    argument_spec.update(
+
+        name=dict(type='str', required=False),  # lists all matching nodes page by page when omitted
+        host=dict(type='str', required=False),  # or hosts
+        user=dict(type='str', required=False),
+        password=dict(type='str', required=False, no_log=True),
+
+        # narrow the listing down on the server
+        cluster=dict(type='str', required=False),
+        filters=dict(type='dict', required=False),      # server side query parameters, e.g. state: active
+
+        match=dict(type='dict', required=False),        # client side (dotted) field values, applied as pages arrive
+        page_size=dict(type='int', required=False),     # default: 1000
+        ndjson_path=dict(type='path', required=False),  # write one object per line to this file instead of returning them
+
+        # provisioning progress of the cluster's node pools instead of the nodes, optionally waited on
+        progress=dict(type='bool', required=False),
+        wait_for=dict(type='dict', required=False, options=dict(
+            roles=dict(type='list', elements='str', required=False, choices=['etcd', 'controlplane', 'worker']),
+            workers=dict(type='int', required=False),                  # at least this many active worker nodes
+            pools=dict(type='list', elements='str', required=False),  # node pools with all of their nodes active
+        )),
+        wait_timeout=dict(type='int', required=False, default=600),
+        wait_delay=dict(type='int', required=False, default=2),  # first poll delay, grows up to 30 seconds
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        required_one_of=[['host', 'hosts']],
+        mutually_exclusive=[['host', 'hosts'], ['hosts', 'progress'], ['hosts', 'wait_for']],
+        required_by=dict(host=['user', 'password'], progress='cluster', wait_for='cluster'),
+        supports_check_mode=False
+    )
+
+    if module.params.get('hosts'):
+        # the same listing against every server at once, a server without the cluster is reported as failed
+        list_objects(module, 'node', RETURN_FIELDS, read=lambda client: read_it(module, client))
+
+    client = RancherClient(module)
+
+    try:
+        if module.params.get('progress') or module.params.get('wait_for'):
+            cluster = client.resolve('cluster', module.params.get('cluster'))
+            if not cluster:
+                module.fail_json(msg="The cluster {} does not exist.".format(module.params.get('cluster')))
+            progress_it(module, client, cluster['id'])
+
+        list_objects(module, 'node', RETURN_FIELDS, read=lambda client: read_it(module, client), client=client)
+
+    except urllib_request.HTTPError as e:
+        module.fail_json(msg=json.loads(e.fp.read()))
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+
+def read_it(module, client):
+    # the nodes by name, cluster and filters, page by page
+    params = dict(module.params.get('filters') or {})
+    if module.params.get('name'):
+        params['name'] = module.params.get('name')
+    if module.params.get('cluster'):
+        cluster = client.resolve('cluster', module.params.get('cluster'))
+        if not cluster:
+            raise ValueError("The cluster {} does not exist.".format(module.params.get('cluster')))
+        params['clusterId'] = cluster['id']
+
+    return client.iter_collection('/v3/node', params=params, match=module.params.get('match'),
+                                  page_size=module.params.get('page_size'))
+
+
+def progress_it(module, client, cluster_id):
+    wait_for = module.params.get('wait_for') or {}
+    started = time.time()
+    deadline = started + module.params.get('wait_timeout')
+    delay = module.params.get('wait_delay')
+    timing = dict(method='poll', polls=0)
+
+    # the node pools and all nodes of the cluster, two requests per poll however many pools there are
+    progress = read_progress(client, cluster_id)
+    timing['polls'] += 1
+    waiting = pending(progress, wait_for)
+    while waiting and time.time() < deadline:
+        time.sleep(min(delay, deadline - time.time()))
+        delay = min(delay * 1.5, 30)
+        progress = read_progress(client, cluster_id)
+        timing['polls'] += 1
+        waiting = pending(progress, wait_for)
+
+    if not wait_for:
+        module.exit_json(changed=False, progress=progress)
+
+    timing.update(elapsed=round(time.time() - started, 3), reached=not waiting, pending=waiting)
+    if waiting:
+        module.fail_json(msg="Timed out waiting for the nodes of the cluster {}: {}.".format(
+            module.params.get('cluster'), ", ".join(waiting)), progress=progress, wait=timing)
+    module.exit_json(changed=False, progress=progress, wait=timing)
+
+
+def read_progress(client, cluster_id):
+    pools = dict((pool['id'], dict(
+        name=pool['name'], quantity=pool.get('quantity') or 0, nodes=0, active=0, states={},
+        roles=[role for flag, role in ROLES if pool.get(flag)],
+    )) for pool in client.iter_collection('/v3/nodepool', params={'clusterId': cluster_id}))
+
+    for node in client.iter_collection('/v3/node', params={'clusterId': cluster_id}):
+        pool = pools.get(node.get('nodePoolId'))
+        if not pool:
+            continue
+        state = node.get('state') or 'unknown'
+        pool['nodes'] += 1
+        pool['active'] += int(state == 'active')
+        pool['states'][state] = pool['states'].get(state, 0) + 1
+
+    # a role is as far as all of the pools that have it, nodes not created yet count as not active
+    roles = dict((role, dict(quantity=0, active=0)) for flag, role in ROLES)
+    for pool in pools.values():
+        for role in pool['roles']:
+            roles[role]['quantity'] += pool['quantity']
+            roles[role]['active'] += min(pool['active'], pool['quantity'])
+
+    return dict(pools=dict((pool.pop('name'), pool) for pool in pools.values()), roles=roles)
+
+
+def pending(progress, wait_for):
+    # what is still missing, an empty list once every condition of wait_for holds
+    waiting = []
+    for role in wait_for.get('roles') or []:
+        counts = progress['roles'][role]
+        if counts['active'] < counts['quantity'] or not counts['quantity']:
+            waiting.append("{} {}/{} active".format(role, counts['active'], counts['quantity']))
+
+    if wait_for.get('workers') and progress['roles']['worker']['active'] < wait_for['workers']:
+        waiting.append("worker {}/{} active".format(progress['roles']['worker']['active'], wait_for['workers']))
+
+    for name in wait_for.get('pools') or []:
+        pool = progress['pools'].get(name)
+        if not pool:
+            waiting.append("node pool {} does not exist".format(name))
+        elif pool['active'] < pool['quantity']:
+            waiting.append("node pool {} {}/{} active".format(name, pool['active'], pool['quantity']))
+    return waiting
+
+
+if __name__ == '__main__':
+    main()
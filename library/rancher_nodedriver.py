@@ -2,12 +2,17 @@
 
 
 from ansible.module_utils.basic import AnsibleModule, json
-from ansible.module_utils.urls import open_url, urllib_request
+from ansible.module_utils.rancher import RancherClient, nodedriver_apply, rancher_argument_spec
+from ansible.module_utils.urls import urllib_request
+
+
+RETURN_FIELDS = ('active', 'url', 'uiUrl', 'checksum')
 
 
 def main():
 
-    argument_spec = dict(
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(
 
         name=dict(type='str', required=True),
         host=dict(type='str', required=True),
@@ -18,6 +23,12 @@ def main():
         # only required to install, not to delete or get
         url=dict(type='str', required=False),
         uiUrl=dict(type='str', required=False),
+        checksum=dict(type='str', required=False),  # of the driver binary, a changed url or checksum updates the driver
+        whitelist_domains=dict(type='list', elements='str', required=False),
+
+        # wait for the driver to become active (downloaded) within this module run
+        wait_for_active=dict(type='bool', required=False, default=False),
+        wait_timeout=dict(type='int', required=False, default=60),
     )
 
     module = AnsibleModule(
@@ -31,23 +42,10 @@ def main():
 
 
 
+    client = RancherClient(module)
+
     try:
-        result = open_url(
-            url="https://{}/v3/nodedriver?name={}".format(
-                module.params.get("host"),
-                module.params.get("name")
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='GET',
-            # data=json.dumps(module.params),
-        )
+        result = client.query('nodedriver', {'name': module.params.get('name'), 'limit': 1})
 
         resource = json.loads(result.read())
 
@@ -64,17 +62,17 @@ def main():
 
         # Choose workflow based on install status and specified state
         if node_driver_installed and state == "present":
-            module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
+            update_it(module, client, resource, result)
 
         elif node_driver_installed and state == "absent":
             remove_url = resource['data'][0]['links']['remove']
-            delete_it(module, remove_url)
+            delete_it(module, client, remove_url)
 
         elif not node_driver_installed and state == "present":
-            install_it(module)
+            install_it(module, client)
 
         elif not node_driver_installed and state == "absent":
-            module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
+            module.exit_json(changed=False, resource=client.project(resource, *RETURN_FIELDS), status=result.status, reason=result.reason)
 
         else:
             module.fail_json(msg="Could not determine the install state of the specified node driver.")
@@ -83,50 +81,42 @@ def main():
         module.fail_json(msg=json.loads(e.fp.read()))
 
 
-def install_it(module):
-    data = {
-        'name': module.params.get('name'),
-        'active': True,
-        'builtin': False,
-        'url': module.params.get('url'),
-        'uiUrl': module.params.get('uiUrl'),
-        'whitelistDomains': ['*', '10.74.82.71', 'sec01u0peafy11.uathost.prd']
-    }
-    result = open_url(
-        url="https://{}/v3/nodedriver".format(
-            module.params.get("host"),
-            module.params.get("name")
-        ),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='POST',
-        data=json.dumps(data),
-    )
-    resource = json.loads(result.read())
-    module.exit_json(changed=True, resource=resource, reason=result.reason, status=result.status)
-
-
-def delete_it(module, remove_url):
-    result = open_url(
-        url="{}".format(remove_url),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='DELETE',
-    )
+def update_it(module, client, resource, result):
+    driver = resource['data'][0]
+
+    # the same url and checksum, nothing to download again, and an active driver needs no wait
+    outcome = nodedriver_apply(client, module.params, driver)
+    if not outcome['changed'] and (not module.params.get('wait_for_active') or driver.get('state') == "active"):
+        module.exit_json(changed=False, resource=client.project(resource, *RETURN_FIELDS), status=result.status,
+                         reason=result.reason)
+    if not outcome['changed']:
+        wait_it(module, client, driver, changed=False, status=result.status, reason=result.reason)
+
+    wait_it(module, client, outcome.pop('resource'), **outcome)
+
+
+def install_it(module, client):
+    outcome = nodedriver_apply(client, module.params)
+    wait_it(module, client, outcome.pop('resource'), **outcome)
+
+
+def wait_it(module, client, driver, **result):
+    if not module.params.get('wait_for_active'):
+        module.exit_json(resource=client.project(driver, *RETURN_FIELDS), **result)
+
+    item, timing = client.wait_for_state('nodedriver', module.params.get('name'), "active",
+                                         module.params.get('wait_timeout'))
+    if not timing['reached']:
+        module.fail_json(msg="Timed out waiting for the node driver {} to become active, it is {}.".format(
+            module.params.get('name'), item.get('state') if item else 'missing'),
+            resource=client.project(item or driver, *RETURN_FIELDS), wait=timing, **result)
+    module.exit_json(resource=client.project(item, *RETURN_FIELDS), wait=timing, **result)
+
+
+def delete_it(module, client, remove_url):
+    result = client.delete(remove_url)
     resource = json.loads(result.read())
-    module.exit_json(changed=True, resource=resource, reason=result.reason, status=result.status)
+    module.exit_json(changed=True, resource=client.project(resource, *RETURN_FIELDS), reason=result.reason, status=result.status)
 
 
 if __name__ == '__main__':
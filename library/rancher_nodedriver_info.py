@@ -2,17 +2,34 @@
 
 
 from ansible.module_utils.basic import AnsibleModule, json
-from ansible.module_utils.urls import open_url, urllib_request
+from ansible.module_utils.rancher import RancherClient, fleet_argument_spec, list_objects, rancher_argument_spec
+from ansible.module_utils.urls import urllib_request
+
+
+RETURN_FIELDS = ('active', 'url', 'uiUrl')
 
 
 def main():
 
-    argument_spec = dict(
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(fleet_argument_spec())
+    argument_spec.update(
+
+        name=dict(type='str', required=False),  # lists all objects page by page when omitted
+        host=dict(type='str', required=False),  # or hosts
+        user=dict(type='str', required=False),
+        password=dict(type='str', required=False, no_log=True),
+
+        # wait for the state within this module run instead of until/retries
+        wait_for_state=dict(type='str', required=False),
+        wait_timeout=dict(type='int', required=False, default=600),
+        wait_delay=dict(type='int', required=False, default=2),  # first poll delay, grows up to 30 seconds
 
-        name=dict(type='str', required=True),
-        host=dict(type='str', required=True),
-        user=dict(type='str', required=True),
-        password=dict(type='str', required=True, no_log=True),
+        # list mode, without a name
+        filters=dict(type='dict', required=False),      # server side query parameters, e.g. state: active
+        match=dict(type='dict', required=False),        # client side (dotted) field values, applied as pages arrive
+        page_size=dict(type='int', required=False),     # default: 1000
+        ndjson_path=dict(type='path', required=False),  # write one object per line to this file instead of returning them
 
         # only required to install, not to delete or get
         url=dict(type='str', required=False),
@@ -21,32 +38,49 @@ def main():
 
     module = AnsibleModule(
         argument_spec=argument_spec,
+        required_one_of=[['host', 'hosts']],
+        mutually_exclusive=[['host', 'hosts'], ['hosts', 'wait_for_state']],
+        required_by=dict(host=['user', 'password'], wait_for_state='name'),
         supports_check_mode=False
     )
 
+    if module.params.get('hosts'):
+        # the same lookup or listing against every server at once
+        list_objects(module, 'nodedriver', RETURN_FIELDS)
+
+    client = RancherClient(module)
+
     try:
-        result = open_url(
-            url="https://{}/v3/nodedriver?name={}".format(
-                module.params.get("host"),
-                module.params.get("name")
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='GET',
-        )
+        if module.params.get('wait_for_state'):
+            wait_it(module, client)
+
+        if not module.params.get('name'):
+            list_objects(module, 'nodedriver', RETURN_FIELDS, client=client)
+
+        result = client.get('/v3/nodedriver', params={'name': module.params.get('name'), 'limit': 1})
 
         resource = json.loads(result.read())
-        module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
+        module.exit_json(changed=False, resource=client.project(resource, *RETURN_FIELDS), status=result.status, reason=result.reason)
 
     except urllib_request.HTTPError as e:
         module.fail_json(msg=json.loads(e.fp.read()))
 
 
+def wait_it(module, client):
+    item, timing = client.wait_for_state(
+        'nodedriver', module.params.get('name'), module.params.get('wait_for_state'),
+        module.params.get('wait_timeout'), module.params.get('wait_delay')
+    )
+    if not item:
+        module.fail_json(msg="The node driver {} does not exist.".format(module.params.get('name')), wait=timing)
+
+    resource = client.project(dict(type='collection', data=[item]), *RETURN_FIELDS)
+    if not timing['reached']:
+        module.fail_json(msg="Timed out waiting for the node driver state {}, it is {}.".format(
+            module.params.get('wait_for_state'), item.get('state')), resource=resource, wait=timing)
+
+    module.exit_json(changed=False, resource=resource, wait=timing)
+
+
 if __name__ == '__main__':
     main()
@@ -2,28 +2,49 @@
 
 
 from ansible.module_utils.basic import AnsibleModule, json
-from ansible.module_utils.urls import open_url, urllib_request
+from ansible.module_utils.rancher import RancherClient, pool_apply, rancher_argument_spec, run_concurrently
+from ansible.module_utils.urls import urllib_request
+
+
+RETURN_FIELDS = ('quantity', 'clusterId', 'nodeTemplateId')
 
 
 def main():
 
-    argument_spec = dict(
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(
 
-        name=dict(type='str', required=True),
+        name=dict(type='str', required=False),
         host=dict(type='str', required=True),
         state=dict(type='str', required=False),  # default: present
         user=dict(type='str', required=True),
         password=dict(type='str', required=True, no_log=True),
-        prefix=dict(type='str', required=True),
-        quantity=dict(type='int', required=True),
-        controlplane=dict(type='bool', required=True),
-        etcd=dict(type='bool', required=True),
-        worker=dict(type='bool', required=True),
+        prefix=dict(type='str', required=False),          # required for state present, here or per pool
+        quantity=dict(type='int', required=False),        # required for state present, here or per pool
+        controlplane=dict(type='bool', required=False),   # required for state present, here or per pool
+        etcd=dict(type='bool', required=False),           # required for state present, here or per pool
+        worker=dict(type='bool', required=False),         # required for state present, here or per pool
         cluster=dict(type='str', required=True),
+        template=dict(type='str', required=False),  # default: same name as the pool
+
+        # batch mode: one entry per pool of the cluster, unset keys fall back to the module level options above
+        pools=dict(type='list', elements='dict', required=False, options=dict(
+            name=dict(type='str', required=True),
+            state=dict(type='str', required=False),
+            template=dict(type='str', required=False),  # default: same name as the pool
+            prefix=dict(type='str', required=False),
+            quantity=dict(type='int', required=False),
+            controlplane=dict(type='bool', required=False),
+            etcd=dict(type='bool', required=False),
+            worker=dict(type='bool', required=False),
+        )),
+        parallelism=dict(type='int', required=False, default=4),
     )
 
     module = AnsibleModule(
         argument_spec=argument_spec,
+        required_one_of=[['name', 'pools']],
+        mutually_exclusive=[['name', 'pools']],
         supports_check_mode=False
     )
 
@@ -31,24 +52,23 @@ def main():
     if state not in ['present', 'absent']:
         module.fail_json(msg="The state specified may only be either 'present' or 'absent'.")
 
+    client = RancherClient(module)
 
+    if module.params.get('pools'):
+        batch_it(module, client)
+
+    check_spec(module, module.params, state)
 
     try:
-        result = open_url(
-            url="https://{}/v3/nodepool?name={}".format(
-                module.params.get("host"),
-                module.params.get("name")
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='GET',
-        )
+        # pools are named per cluster, look in the cluster's pools only
+        cluster = client.resolve('cluster', module.params.get('cluster'))
+        if not cluster:
+            if state == "present":
+                module.fail_json(msg="The cluster {} does not exist.".format(module.params.get('cluster')))
+            module.exit_json(changed=False)
+        cluster_id = cluster['id']
+
+        result = client.query('nodepool', {'name': module.params.get('name'), 'clusterId': cluster_id, 'limit': 1})
 
         resource = json.loads(result.read())
         # module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
@@ -65,19 +85,17 @@ def main():
 
         # Choose workflow based on install status and specified state
         if node_pool_installed and state == "present":
-            # todo: we might have to update it # put
-            # update_it(module)
-            module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
+            update_it(module, client, resource, cluster_id) # put
 
         elif node_pool_installed and state == "absent":
             remove_url = resource['data'][0]['links']['remove']
-            delete_it(module, remove_url)
+            delete_it(module, client, remove_url)
 
         elif not node_pool_installed and state == "present":
-            install_it(module) # post
+            install_it(module, client, cluster_id) # post
 
         elif not node_pool_installed and state == "absent":
-            module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
+            module.exit_json(changed=False, resource=client.project(resource, *RETURN_FIELDS), status=result.status, reason=result.reason)
 
         else:
             module.fail_json(msg="Could not determine the install state of the specified node driver.")
@@ -86,96 +104,108 @@ def main():
         module.fail_json(msg=json.loads(e.fp.read()))
 
 
-def update_it(module):
-    pass
+def update_it(module, client, resource, cluster_id):
+    pool = resource['data'][0]
 
+    outcome = pool_apply(client, module.params, cluster_id, template_it(module, client), pool)
+    if not outcome['changed']:
+        module.exit_json(changed=False, resource=client.project(resource, *RETURN_FIELDS))
+    module.exit_json(resource=client.project(outcome.pop('resource'), *RETURN_FIELDS), **outcome)
 
-def install_it(module):
 
-    # get the clusterId
-    result = open_url(
-        url="https://{}/v3/cluster?name={}".format(
-            module.params.get("host"),
-            module.params.get("cluster")
-        ),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='GET',
-    )
-    cluster_resource = json.loads(result.read())
-    cluster_id = cluster_resource['data'][0]['id']
-
-    # get the nodeTemplateId
-    result = open_url(
-        url="https://{}/v3/nodetemplate?name={}".format(
-            module.params.get("host"),
-            module.params.get("name")
-        ),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='GET',
-    )
-    template_resource = json.loads(result.read())
-    template_id = template_resource['data'][0]['id']
+def check_spec(module, spec, state):
+    missing = [key for key in ('prefix', 'quantity', 'controlplane', 'etcd', 'worker') if spec.get(key) is None]
+    if state == "present" and missing:
+        module.fail_json(msg="missing required arguments for node pool {}: {}".format(
+            spec.get('name'), ", ".join(missing)))
+
+
+def batch_it(module, client):
+    specs = []
+    for pool in module.params.get('pools'):
+        spec = dict(module.params)
+        spec.update((key, value) for key, value in pool.items() if value is not None)
+        spec['state'] = spec.get('state') or "present"
+        spec['template'] = spec.get('template') or spec['name']
+        if spec['state'] not in ['present', 'absent']:
+            module.fail_json(msg="The state specified may only be either 'present' or 'absent'.")
+        check_spec(module, spec, spec['state'])
+        specs.append(spec)
+
+    try:
+        # the cluster is resolved once for all pools
+        cluster = client.resolve('cluster', module.params.get('cluster'))
+        if not cluster:
+            if any(spec['state'] == "present" for spec in specs):
+                module.fail_json(msg="The cluster {} does not exist.".format(module.params.get('cluster')))
+            module.exit_json(changed=False, results=[dict(name=spec['name'], state=spec['state'], changed=False)
+                                                     for spec in specs])
+        cluster_id = cluster['id']
+
+        existing = dict((pool['name'], pool) for pool in client.iter_collection('/v3/nodepool',
+                                                                                 params={'clusterId': cluster_id}))
+
+        # name->id map of the node templates, to create pools and to compare the template of existing ones
+        template_ids = {}
+        if any(spec['state'] == "present" for spec in specs):
+            templates = list(client.iter_collection('/v3/nodetemplate',
+                                                    match={'name': [spec['template'] for spec in specs]}))
+            template_ids = dict((template['name'], template['id']) for template in templates)
+            client.remember('nodetemplate', templates)
+
+    except urllib_request.HTTPError as e:
+        module.fail_json(msg=json.loads(e.fp.read()))
+
+    results = run_concurrently(lambda spec: apply_it(client, spec, existing.get(spec['name']), cluster_id, template_ids),
+                               specs, module.params.get('parallelism'))
+
+    changed = any(item['changed'] for item in results)
+    failed = [item['name'] for item in results if item.get('failed')]
+    if failed:
+        module.fail_json(msg="Failed to apply node pools: {}".format(", ".join(failed)),
+                         changed=changed, results=results)
+    module.exit_json(changed=changed, results=results)
 
+
+def apply_it(client, spec, pool, cluster_id, template_ids):
+    item = dict(name=spec['name'], state=spec['state'], changed=False)
+    try:
+        if pool and spec['state'] == "absent":
+            result = client.delete(pool['links']['remove'])
+            item.update(changed=True, status=result.status, reason=result.reason)
+
+        elif spec['state'] == "present":
+            if spec['template'] not in template_ids:
+                item.update(failed=True, msg="The node template {} does not exist.".format(spec['template']))
+                return item
+            outcome = pool_apply(client, spec, cluster_id, template_ids[spec['template']], pool)
+            item.update(outcome, resource=client.project(outcome['resource'], *RETURN_FIELDS))
+
+    except urllib_request.HTTPError as e:
+        item.update(failed=True, status=e.code, msg=json.loads(e.fp.read()))
+
+    return item
+
+
+def template_it(module, client):
+    # the nodeTemplateId, the template defaults to the pool's name
+    name = module.params.get('template') or module.params.get('name')
+    template = client.resolve('nodetemplate', name)
+    if not template:
+        module.fail_json(msg="The node template {} does not exist.".format(name))
+    return template['id']
+
+
+def install_it(module, client, cluster_id):
     # create the nodepool
-    data = {
-        "name": module.params.get('name'),
-        "clusterId": cluster_id,
-        "nodeTemplateId": template_id,
-        "hostnamePrefix": module.params.get('prefix'),
-        "quantity": module.params.get('quantity'),
-        "controlPlane": module.params.get('controlplane'),
-        "etcd": module.params.get('etcd'),
-        "worker": module.params.get('worker'),
-    }
-    result = open_url(
-        url="https://{}/v3/nodepool".format(
-            module.params.get("host"),
-            module.params.get("name")
-        ),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='POST',
-        data=json.dumps(data),
-    )
-    resource = json.loads(result.read())
-    module.exit_json(changed=True, resource=resource, reason=result.reason, status=result.status)
-
-
-def delete_it(module, remove_url):
-    result = open_url(
-        url="{}".format(remove_url),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='DELETE',
-    )
+    outcome = pool_apply(client, module.params, cluster_id, template_it(module, client))
+    module.exit_json(resource=client.project(outcome.pop('resource'), *RETURN_FIELDS), **outcome)
+
+
+def delete_it(module, client, remove_url):
+    result = client.delete(remove_url)
     resource = json.loads(result.read())
-    module.exit_json(changed=True, resource=resource, reason=result.reason, status=result.status)
+    module.exit_json(changed=True, resource=client.project(resource, *RETURN_FIELDS), reason=result.reason, status=result.status)
 
 
 if __name__ == '__main__':
@@ -2,13 +2,15 @@
 
 
 from ansible.module_utils.basic import AnsibleModule, json
-from ansible.module_utils.urls import open_url, urllib_request
+from ansible.module_utils.rancher import RancherClient, rancher_argument_spec, run_concurrently, template_data
+from ansible.module_utils.urls import urllib_request
 
 
 def main():
 
-    argument_spec = dict(
-        name=dict(type='str', required=True),
+    argument_spec = rancher_argument_spec()
+    argument_spec.update(
+        name=dict(type='str', required=False),
         host=dict(type='str', required=True),
         state=dict(type='str', required=False),  # default: present
         user=dict(type='str', required=True),
@@ -18,18 +20,34 @@ def main():
         region=dict(type='str', required=True),
         network=dict(type='str', required=True),
         ssh_user=dict(type='str', required=False),
-        cpu=dict(type='int', required=True),
-        memory=dict(type='int', required=True),
-        disk=dict(type='int', required=True),
+        cpu=dict(type='int', required=False),     # required for state present, here or per template
+        memory=dict(type='int', required=False),  # required for state present, here or per template
+        disk=dict(type='int', required=False),    # required for state present, here or per template
         labels=dict(type='dict', required=False),
         image=dict(type='str', required=True),
         engine_install_url=dict(type='str', required=True),
         engine_storage_driver=dict(type='str', required=True),
         engine_options=dict(type='dict', required=True),
+
+        # batch mode: one entry per template, unset keys fall back to the module level options above
+        templates=dict(type='list', elements='dict', required=False, options=dict(
+            name=dict(type='str', required=True),
+            state=dict(type='str', required=False),
+            cpu=dict(type='int', required=False),
+            memory=dict(type='int', required=False),
+            disk=dict(type='int', required=False),
+            labels=dict(type='dict', required=False),
+            image=dict(type='str', required=False),
+            region=dict(type='str', required=False),
+            network=dict(type='str', required=False),
+        )),
+        parallelism=dict(type='int', required=False, default=4),
     )
 
     module = AnsibleModule(
         argument_spec=argument_spec,
+        required_one_of=[['name', 'templates']],
+        mutually_exclusive=[['name', 'templates']],
         supports_check_mode=False
     )
 
@@ -37,22 +55,15 @@ def main():
     if state not in ['present', 'absent']:
         module.fail_json(msg="The state specified may only be either 'present' or 'absent'.")
 
+    client = RancherClient(module)
+
+    if module.params.get('templates'):
+        batch_it(module, client)
+
+    check_spec(module, module.params, state)
+
     try:
-        result = open_url(
-            url="https://{}/v3/nodetemplate?name={}".format(
-                module.params.get("host"),
-                module.params.get("name")
-            ),
-            url_username=module.params.get("user"),
-            url_password=module.params.get("password"),
-            force_basic_auth=True,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            validate_certs=False,
-            method='GET',
-        )
+        result = client.query('nodetemplate', {'name': module.params.get('name'), 'limit': 1})
 
         resource = json.loads(result.read())
 
@@ -69,17 +80,17 @@ def main():
 
         # Choose workflow based on node template existence and specified state
         if template_exists and state == "present":
-            module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
+            module.exit_json(changed=False, resource=client.project(resource), status=result.status, reason=result.reason)
 
         elif template_exists and state == "absent":
             remove_url = resource['data'][0]['links']['remove']
-            delete_it(module, remove_url)
+            delete_it(module, client, remove_url)
 
         elif not template_exists and state == "present":
-            install_it(module)
+            install_it(module, client)
 
         elif not template_exists and state == "absent":
-            module.exit_json(changed=False, resource=resource, status=result.status, reason=result.reason)
+            module.exit_json(changed=False, resource=client.project(resource), status=result.status, reason=result.reason)
 
         else:
             module.fail_json(msg="Could not determine the install state of the specified node template.")
@@ -88,58 +99,75 @@ def main():
         module.fail_json(msg=json.loads(e.fp.read()))
 
 
-def install_it(module):
-    data = {
-        "name": module.params.get('name'),
-        "eportalConfig": {
-            "cpu": module.params.get('cpu'),
-            "memory": module.params.get('memory'),
-            "disk": module.params.get('disk'),
-            "location": module.params.get('region'),
-            "os": module.params.get('image'),
-            # "sshUser": module.params.get('ssh_user'), # because local_prodadmin is baked into eportal backend anyway
-            "server": module.params.get('server'),
-            "token": module.params.get('token'),
-            "vlan": module.params.get('network'),
-        },
-        "engineInstallURL": module.params.get('engine_install_url'),
-        "engineStorageDriver": module.params.get('engine_storage_driver'),
-        "engineOpt": module.params.get('engine_options'),
-        "labels": module.params.get('labels')
-    }
-
-    result = open_url(
-        url="https://{}/v3/nodetemplate".format(
-            module.params.get("host"),
-        ),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='POST',
-        data=json.dumps(data),
-    )
+def check_spec(module, spec, state):
+    missing = [key for key in ('cpu', 'memory', 'disk') if spec.get(key) is None]
+    if state == "present" and missing:
+        module.fail_json(msg="missing required arguments for node template {}: {}".format(
+            spec.get('name'), ", ".join(missing)))
+
+
+def batch_it(module, client):
+    specs = []
+    for template in module.params.get('templates'):
+        spec = dict(module.params)
+        spec.update((key, value) for key, value in template.items() if value is not None)
+        spec['state'] = spec.get('state') or "present"
+        if spec['state'] not in ['present', 'absent']:
+            module.fail_json(msg="The state specified may only be either 'present' or 'absent'.")
+        check_spec(module, spec, spec['state'])
+        specs.append(spec)
+
+    try:
+        # one collection query instead of one ?name= lookup per template
+        templates = list(client.iter_collection('/v3/nodetemplate', match={'name': [spec['name'] for spec in specs]}))
+        existing = dict((template['name'], template) for template in templates)
+        client.remember('nodetemplate', templates)
+
+    except urllib_request.HTTPError as e:
+        module.fail_json(msg=json.loads(e.fp.read()))
+
+    results = run_concurrently(lambda spec: apply_it(client, spec, existing.get(spec['name'])),
+                               specs, module.params.get('parallelism'))
+
+    changed = any(item['changed'] for item in results)
+    failed = [item['name'] for item in results if item.get('failed')]
+    if failed:
+        module.fail_json(msg="Failed to apply node templates: {}".format(", ".join(failed)),
+                         changed=changed, results=results)
+    module.exit_json(changed=changed, results=results)
+
+
+def apply_it(client, spec, template):
+    item = dict(name=spec['name'], state=spec['state'], changed=False)
+    try:
+        if template and spec['state'] == "absent":
+            result = client.delete(template['links']['remove'])
+            item.update(changed=True, status=result.status, reason=result.reason)
+
+        elif not template and spec['state'] == "present":
+            result = client.post('/v3/nodetemplate', data=template_data(spec))
+            resource = json.loads(result.read())
+            client.remember('nodetemplate', [resource])
+            item.update(changed=True, status=result.status, reason=result.reason, resource=client.project(resource))
+
+        elif template:
+            item.update(resource=client.project(template))
+
+    except urllib_request.HTTPError as e:
+        item.update(failed=True, status=e.code, msg=json.loads(e.fp.read()))
+
+    return item
+
+
+def install_it(module, client):
+    result = client.post('/v3/nodetemplate', data=template_data(module.params))
     resource = json.loads(result.read())
-    module.exit_json(changed=True, reason=result.reason, status=result.status, resource=resource)
-
-
-def delete_it(module, remove_url):
-    result = open_url(
-        url="{}".format(remove_url),
-        url_username=module.params.get("user"),
-        url_password=module.params.get("password"),
-        force_basic_auth=True,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        validate_certs=False,
-        method='DELETE',
-    )
+    client.remember('nodetemplate', [resource])
+    module.exit_json(changed=True, reason=result.reason, status=result.status, resource=client.project(resource))
+
+
+def delete_it(module, client, remove_url):
+    result = client.delete(remove_url)
     module.exit_json(changed=True, reason=result.reason, status=result.status)
 
 
@@ -0,0 +1,1512 @@
+# -*- coding: utf-8 -*-
+
+# Shared Rancher v3 API client for the modules in library/.
+#
+# open_url() opens a fresh (TLS) connection for every call.  RancherClient keeps a small pool of
+# keep-alive connections per server and reuses them for every request made during a module run, or
+# across the module runs of a task (loops, until retries) when the action plugins run them in-process.
+#
+# Name to id lookups are kept in a small JSON file on the controller (see RancherIdCache) so that
+# repeated ?name= queries across the tasks of a playbook run cost no round trips.
+#
+# rancher_facts writes whole collections to a snapshot file (see RancherSnapshot), refreshed with
+# If-None-Match.  With snapshot_max_age set, query() and iter_collection() read from it instead of the API.
+#
+# Responses are requested gzip compressed and only decompressed when read.  With ijson installed,
+# iter_items() parses the objects of a collection one at a time from the compressed body.
+#
+# Every request is timed (see RancherMetrics), modules return a summary as rancher_metrics and, with
+# trace_path or RANCHER_TRACE_PATH set, append one JSON line per request to a trace file.
+#
+# Failed requests are retried with jittered exponential backoff (or after Retry-After): connection errors
+# and 409/429/502/503/504 answers for GET, PUT and DELETE, only 429 and 503 for POSTs.  After repeated
+# failures a per server circuit breaker fails requests right away for a while.
+#
+# RANCHER_RATE_LIMIT and RANCHER_MAX_IN_FLIGHT share a token bucket and an in-flight count per server
+# between all module processes on the controller (see RancherRateLimiter), so many forks or parallel
+# playbooks don't flood Rancher.
+#
+# The API key is exchanged for a bearer token (POST /v3/tokens) once per server and key, see RancherTokenCache.
+# The token is kept on the controller until shortly before it expires and renewed when Rancher answers 401,
+# so Rancher doesn't verify the key's secret on every request.
+#
+# wait_for_state() follows Rancher's /v3/subscribe event stream when websocket-client is installed and
+# falls back to polling with a growing delay over the pooled connection otherwise.
+#
+# The request bodies for node drivers, node templates, clusters and node pools are built here so that
+# rancher_cluster_stack sends exactly what the single object modules send.  run_graph() runs its steps
+# as soon as the steps they depend on are done.
+#
+# Clusters carry a hash of the body they were created or last updated from (see spec_hash), so a rerun
+# with the same settings is decided without comparing the RKE config, and cluster_changes() puts only
+# the fields that differ.
+#
+# The info modules can read several Rancher servers at once (hosts), see fleet_clients() and fan_out().
+
+import base64
+import calendar
+import errno
+import fcntl
+import gzip
+import hashlib
+import hmac
+import os
+import random
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import mktime_tz, parsedate_tz
+from io import BytesIO
+
+from ansible.module_utils.basic import json
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.six.moves.urllib.parse import parse_qsl, urlencode, urlsplit
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
+from ansible.module_utils.urls import urllib_request
+
+try:
+    import websocket
+    HAS_WEBSOCKET = True
+except ImportError:
+    HAS_WEBSOCKET = False
+
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+
+DEFAULT_CACHE_PATH = '~/.ansible/tmp/rancher_ids.json'
+DEFAULT_CACHE_TTL = 300
+
+DEFAULT_SNAPSHOT_PATH = '~/.ansible/tmp/rancher_snapshot.json'
+
+DEFAULT_PAGE_SIZE = 1000
+
+DEFAULT_TIMEOUT = 30.0         # seconds to connect, and to wait for each answer
+DEFAULT_RETRIES = 4
+DEFAULT_RETRY_DELAY = 1.0       # seconds before the first retry, doubled for each one after it
+DEFAULT_RETRY_MAX_DELAY = 30.0
+DEFAULT_CIRCUIT_THRESHOLD = 10  # consecutive failures that open the circuit breaker, 0 disables it
+DEFAULT_CIRCUIT_COOLDOWN = 30.0
+
+DEFAULT_RATE_LIMIT_PATH = '~/.ansible/tmp/rancher_ratelimit.json'
+
+DEFAULT_TOKEN_PATH = '~/.ansible/tmp/rancher_tokens.json'
+DEFAULT_TOKEN_TTL = 3600        # seconds a login token is asked for, 0 sends the API key with every request
+TOKEN_REFUSED_TTL = 300         # seconds the API key is sent without trying to log in after Rancher refused it
+
+DEFAULT_HOST_TIMEOUT = 60       # seconds the info modules wait for each server of hosts
+
+# Rancher answers these while it is busy reconciling, they are worth another try
+RETRY_STATUSES = (409, 429, 502, 503, 504)
+
+# requests that can be repeated after a connection error, POSTs only when Rancher refused them outright
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+REFUSED_STATUSES = (429, 503)
+
+# POST actions without side effects worth protecting against a repeat.  Not generateKubeconfig: every call
+# creates another token in Rancher
+SAFE_ACTIONS = ()
+
+# POST actions that change none of the snapshot collections, they leave the snapshots alone
+READ_ACTIONS = ('generateKubeconfig',)
+
+# errors sending on a kept-alive connection the server already closed: the request never reached it, so it
+# can be sent again whatever the method.  A timeout waiting for the answer is not one of them
+UNSENT_ERRORS = (BrokenPipeError, ConnectionResetError, http_client.RemoteDisconnected)
+
+# writes to a collection also change these, their snapshots are dropped along with it
+SNAPSHOT_DEPENDENTS = {'cluster': ['nodepool', 'node', 'clusterregistrationtoken'], 'nodepool': ['node']}
+
+# Rancher's type names as used by /v3/subscribe events
+EVENT_TYPES = {'cluster': 'cluster', 'nodedriver': 'nodeDriver', 'nodepool': 'nodePool', 'node': 'node'}
+
+# the domains a node driver's UI may load from, unless whitelist_domains says otherwise
+DEFAULT_WHITELIST_DOMAINS = ['*', '10.74.82.71', 'sec01u0peafy11.uathost.prd']
+
+# cluster annotation holding the spec_hash() of the body the cluster was last written from
+SPEC_HASH_ANNOTATION = 'rancher-k8s/spec-hash'
+
+# what modules return for each object unless return_fields asks for more, ['*'] returns everything.  Modules
+# add the fields of their own objects with a RETURN_FIELDS tuple passed to RancherClient.project()
+DEFAULT_FIELDS = ['id', 'name', 'state', 'transitioning', 'transitioningMessage', 'links.self', 'links.remove']
+
+
+class RancherResponse(object):
+
+    def __init__(self, url, status, reason, headers, body, encoding=None, from_snapshot=False):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.raw = body
+        self.encoding = encoding
+        self.from_snapshot = from_snapshot  # answered by query() from a snapshot, the objects may be trimmed
+        self._body = None if encoding else body
+
+    def stream(self):
+        if self.encoding == 'gzip':
+            return gzip.GzipFile(fileobj=BytesIO(self.raw))
+        return BytesIO(self.raw)
+
+    def read(self):
+        if self._body is None:
+            self._body = self.stream().read()
+        return self._body
+
+    def json(self):
+        body = self.read()
+        return json.loads(body) if body else {}
+
+    def iter_items(self):
+        # the objects of a collection, without building the whole document when ijson is available
+        if HAS_IJSON and self.raw and self._body is None:
+            return ijson.items(self.stream(), 'data.item', use_float=True)
+        return iter(self.json().get('data') or [])
+
+    def next_page(self):
+        if HAS_IJSON and self.raw and self._body is None:
+            return next(ijson.items(self.stream(), 'pagination.next'), None)
+        return (self.json().get('pagination') or {}).get('next')
+
+
+class RancherClient(object):
+
+    # idle connections are shared by all clients of a process, the action plugins run many modules in one
+    _idle = {}
+    _lock = threading.Lock()
+
+    def __init__(self, module, host=None, user=None, password=None, validate_certs=False, timeout=None, pool_size=8,
+                 metrics=None):
+        self.module = module
+        self.host = host or module.params.get('host')
+        self.validate_certs = validate_certs
+        self.timeout = timeout or setting(module, 'request_timeout', 'RANCHER_TIMEOUT', DEFAULT_TIMEOUT, float)
+        self.pool_size = pool_size
+
+        # host may carry an explicit scheme (e.g. http://127.0.0.1:8080), https is the default
+        if '://' not in self.host:
+            self.base_url = 'https://{}'.format(self.host)
+        else:
+            self.base_url = self.host.rstrip('/')
+
+        user, password = user or module.params.get('user'), password or module.params.get('password')
+        credentials = '{}:{}'.format(user, password)
+        self.headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+            "Authorization": "Basic {}".format(base64.b64encode(credentials.encode('utf-8')).decode('ascii')),
+        }
+
+        token_path = os.environ.get('RANCHER_TOKEN_PATH') or DEFAULT_TOKEN_PATH
+        self.tokens = RancherTokenCache(os.path.expanduser(token_path), self.base_url, user, password,
+                                        setting(module, 'token_ttl', 'RANCHER_TOKEN_TTL', DEFAULT_TOKEN_TTL, int))
+        self._authorized = False
+
+        self.return_fields = module.params.get('return_fields')
+
+        cache_ttl = module.params.get('cache_ttl')
+        if cache_ttl is None:
+            cache_ttl = int(os.environ.get('RANCHER_CACHE_TTL', DEFAULT_CACHE_TTL))
+        cache_path = module.params.get('cache_path') or os.environ.get('RANCHER_CACHE_PATH') or DEFAULT_CACHE_PATH
+        self.cache = RancherIdCache(os.path.expanduser(cache_path), cache_ttl)
+
+        self.retries = setting(module, 'retries', 'RANCHER_RETRIES', DEFAULT_RETRIES, int)
+        self.retry_delay = setting(module, 'retry_delay', 'RANCHER_RETRY_DELAY', DEFAULT_RETRY_DELAY, float)
+        self.retry_max_delay = setting(module, 'retry_max_delay', 'RANCHER_RETRY_MAX_DELAY', DEFAULT_RETRY_MAX_DELAY, float)
+        self.breaker = RancherCircuitBreaker.get(
+            self.base_url,
+            setting(module, 'circuit_threshold', 'RANCHER_CIRCUIT_THRESHOLD', DEFAULT_CIRCUIT_THRESHOLD, int),
+            setting(module, 'circuit_cooldown', 'RANCHER_CIRCUIT_COOLDOWN', DEFAULT_CIRCUIT_COOLDOWN, float))
+
+        rate_limit_path = os.environ.get('RANCHER_RATE_LIMIT_PATH') or DEFAULT_RATE_LIMIT_PATH
+        rate = setting(module, 'rate_limit', 'RANCHER_RATE_LIMIT', 0, float)
+        self.limiter = RancherRateLimiter(
+            os.path.expanduser(rate_limit_path), self.base_url, rate,
+            setting(module, 'rate_burst', 'RANCHER_RATE_BURST', max(1.0, rate), float),
+            setting(module, 'max_in_flight', 'RANCHER_MAX_IN_FLIGHT', 0, int))
+
+        # every result of the module carries the metrics of its requests, however it exits.  The clients of
+        # several servers (see fleet_clients) share the metrics of the first, whose wrapper reports them all
+        if metrics:
+            self.metrics = metrics
+        else:
+            trace_path = module.params.get('trace_path') or os.environ.get('RANCHER_TRACE_PATH')
+            self.metrics = RancherMetrics(os.path.expanduser(trace_path) if trace_path else None)
+            if hasattr(module, 'exit_json'):
+                module.exit_json = self.metrics.wrap(module, module.exit_json)
+                module.fail_json = self.metrics.wrap(module, module.fail_json)
+
+        snapshot_max_age = module.params.get('snapshot_max_age')
+        if snapshot_max_age is None:
+            snapshot_max_age = int(os.environ.get('RANCHER_SNAPSHOT_MAX_AGE', 0))
+        snapshot_path = module.params.get('snapshot_path') or os.environ.get('RANCHER_SNAPSHOT_PATH') or DEFAULT_SNAPSHOT_PATH
+        self.snapshot = RancherSnapshot(os.path.expanduser(snapshot_path), self.base_url, snapshot_max_age)
+
+    def url(self, path, params=None):
+        if path.startswith('/'):
+            path = self.base_url + path
+        if params:
+            path = '{}{}{}'.format(path, '&' if '?' in path else '?', urlencode(params))
+        return path
+
+    def get(self, url, params=None, headers=None):
+        return self.request('GET', url, params=params, headers=headers)
+
+    def post(self, url, data=None, params=None):
+        return self.request('POST', url, data=data, params=params)
+
+    def put(self, url, data=None, params=None):
+        return self.request('PUT', url, data=data, params=params)
+
+    def delete(self, url, params=None):
+        return self.request('DELETE', url, params=params)
+
+    def query(self, kind, params):
+        # ?name= style existence checks, answered from a fresh snapshot without a round trip
+        items = self.snapshot.items(kind)
+        if items is None:
+            return self.get('/v3/{}'.format(kind), params=params)
+
+        wanted = dict((key, value) for key, value in params.items() if key != 'limit')
+        data = [item for item in items if matches(item, wanted)][:params.get('limit')]
+        body = json.dumps(dict(type='collection', data=data)).encode('utf-8')
+        return RancherResponse(self.url('/v3/{}'.format(kind), params), 200, 'OK (snapshot)', {}, body,
+                               from_snapshot=True)
+
+    def iter_collection(self, url, params=None, match=None, page_size=None):
+        # yields the objects of a collection page by page, following pagination.next
+        kind = url[len('/v3/'):] if url.startswith('/v3/') else None
+        items = self.snapshot.items(kind) if kind else None
+        if items is not None:
+            for item in items:
+                if matches(item, params or {}) and (not match or matches(item, match)):
+                    yield item
+            return
+
+        params = dict(params or {}, limit=page_size or DEFAULT_PAGE_SIZE)
+        while url:
+            result = self.get(url, params=params)
+            for item in result.iter_items():
+                if not match or matches(item, match):
+                    yield item
+            url, params = result.next_page(), None
+
+    def resolve(self, kind, name):
+        # returns the cached {id, name, links.self} entry or the live object, None when it does not exist
+        entry = self.cache.get(self.base_url, kind, name)
+        if entry:
+            return entry
+
+        items = [item for item in self.query(kind, {'name': name, 'limit': 1}).iter_items() if item.get('name') == name]
+        if not items:
+            return None
+
+        self.remember(kind, items)
+        return items[0]
+
+    def remember(self, kind, items):
+        self.cache.set(self.base_url, kind, items)
+
+    def wait_for_state(self, kind, name, state, timeout, delay=2, max_delay=30):
+        # returns the object once it reached state (or at the timeout) and how long that took
+        started = time.time()
+        deadline = started + timeout
+        timing = dict(method='poll', polls=0, events=0)
+
+        # subscribe before the first read so that no transition can slip in between
+        subscription = self._subscribe(kind) if HAS_WEBSOCKET else None
+        if subscription:
+            timing['method'] = 'websocket'
+
+        try:
+            result = self.get('/v3/{}'.format(kind), params={'name': name, 'limit': 1})
+            timing['polls'] += 1
+            items = [item for item in result.iter_items() if item.get('name') == name]
+            item = items[0] if items else None
+
+            while item and item.get('state') != state and time.time() < deadline:
+                remaining = deadline - time.time()
+                if subscription:
+                    try:
+                        event = self._next_event(subscription, item['id'], min(max_delay, remaining))
+                    except (websocket.WebSocketException, socket.error, ValueError):
+                        subscription.close()
+                        subscription, timing['method'] = None, 'websocket+poll'
+                        continue
+                    if event:
+                        item = dict(item, **event)
+                        timing['events'] += 1
+                        continue
+                    # no event for max_delay seconds, check that nothing was missed
+                else:
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 1.5, max_delay)
+
+                item = self.get(item['links']['self']).json()
+                timing['polls'] += 1
+        finally:
+            if subscription:
+                subscription.close()
+
+        timing['elapsed'] = round(time.time() - started, 3)
+        timing['reached'] = bool(item) and item.get('state') == state
+        return item, timing
+
+    def _subscribe(self, kind):
+        url = self.url('/v3/subscribe', params={'eventNames': 'resource.change',
+                                                 'resourceType': EVENT_TYPES.get(kind, kind)})
+        url = 'ws' + url[len('http'):]
+        sslopt = {} if self.validate_certs else {'cert_reqs': ssl.CERT_NONE}
+        try:
+            return websocket.create_connection(url, timeout=self.timeout, sslopt=sslopt,
+                                               header=['Authorization: {}'.format(self.headers['Authorization'])])
+        except (websocket.WebSocketException, socket.error):
+            return None
+
+    def _next_event(self, subscription, object_id, wait):
+        until = time.time() + wait
+        while time.time() < until:
+            subscription.settimeout(max(until - time.time(), 0.1))
+            try:
+                message = subscription.recv()
+            except websocket.WebSocketTimeoutException:
+                return None
+            if not message:
+                raise websocket.WebSocketConnectionClosedException("The event subscription was closed.")
+            event = json.loads(message)
+            data = event.get('data') or {}
+            if event.get('name') == 'resource.change' and data.get('id') == object_id:
+                return data
+        return None
+
+    def project(self, resource, *fields):
+        # fields are module specific additions to DEFAULT_FIELDS, return_fields replaces both
+        return project(resource, self.return_fields or DEFAULT_FIELDS + list(fields))
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        url = self.url(url, params)
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        # bytes go out in the same segment as the headers, a str body waits for the delayed ACK
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        # the login itself sends its own Authorization
+        own_authorization = bool(headers and 'Authorization' in headers)
+        if not self._authorized and not own_authorization:
+            self.authorize()
+        extra = headers
+        headers = dict(self.headers, **headers) if headers else self.headers
+        span = dict(method=method, url=url_template(url), retries=0, waited=0.0, throttled=0.0, sent=len(body or ''))
+        started = time.time()
+        action = dict(parse_qsl(parts.query)).get('action')
+        idempotent = method in IDEMPOTENT_METHODS or action in SAFE_ACTIONS
+
+        attempt, fresh, renewed = 0, False, False
+        while True:
+            if not self.breaker.allow(span):
+                self.metrics.record(span, started, error='CircuitOpen')
+                raise http_error(url, 503, 'CircuitOpen', "Too many failed requests to {}, not trying again for {} "
+                                 "seconds.".format(self.base_url, int(self.breaker.remaining()) + 1))
+
+            span['throttled'] = round(span['throttled'] + self.limiter.acquire(), 3)
+            conn, reused = self._acquire(key, fresh)
+            # a request that opened a connection on any of its attempts counts as a new connection
+            span['reused'] = reused and span.get('reused', True)
+            response = error = None
+            sending = True
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sending = False
+                response = conn.getresponse()
+                payload = response.read()
+                self.limiter.release()
+            except (http_client.HTTPException, socket.error) as e:
+                self.limiter.release()
+                conn.close()
+                error = e
+                # the server may have dropped an idle keep-alive connection, retry at once on a fresh one.
+                # Requests that aren't idempotent only when they can't have reached the server
+                unsent = isinstance(e, UNSENT_ERRORS) and (sending or isinstance(e, http_client.RemoteDisconnected))
+                if reused and not fresh and (idempotent or unsent):
+                    fresh = True
+                    span['retries'] += 1
+                    continue
+            else:
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release(key, conn)
+
+            if error is not None or response.status == 429 or response.status >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+            # the token expired early or was deleted, log in again once
+            if (response is not None and response.status == 401 and not renewed and not own_authorization and
+                    headers['Authorization'].startswith('Bearer ')):
+                renewed = True
+                self.authorize(stale=headers['Authorization'])
+                headers = dict(self.headers, **extra) if extra else self.headers
+                span['retries'] += 1
+                continue
+
+            retry = attempt < self.retries and (
+                (error is not None and idempotent) or
+                (response is not None and response.status in RETRY_STATUSES and
+                 (idempotent or response.status in REFUSED_STATUSES)))
+            if not retry:
+                break
+
+            delay = self._retry_delay(attempt, response)
+            attempt += 1
+            span['retries'] += 1
+            span['waited'] = round(span['waited'] + delay, 3)
+            time.sleep(delay)
+
+        if error is not None:
+            self.metrics.record(span, started, error=type(error).__name__)
+            raise http_error(url, 503, 'ConnectionError', "{} failed: {}".format(url_template(url), error))
+
+        self.metrics.record(span, started, status=response.status, received=len(payload))
+
+        # a deleted or vanished object must not be resolved from the cache again
+        if response.status == 404 or (method == 'DELETE' and response.status < 400):
+            self.cache.invalidate(self.base_url, url)
+
+        # so do the snapshots of a collection that was written to
+        if method != 'GET' and response.status < 400 and action not in READ_ACTIONS:
+            self.snapshot.invalidate(parts.path)
+
+        result = RancherResponse(url, response.status, response.reason, response.msg, payload,
+                                 response.getheader('Content-Encoding'))
+        if response.status >= 400:
+            raise http_error(url, response.status, response.reason, result.read(), response.msg)
+
+        return result
+
+    def authorize(self, stale=None):
+        # a cached or new bearer token, the API key itself when Rancher won't hand out tokens
+        self.headers['Authorization'] = self.tokens.header(self._login, stale)
+        self._authorized = True
+
+    def _login(self, basic):
+        data = {'type': 'token', 'description': 'rancher-k8s ansible modules', 'ttl': self.tokens.ttl * 1000}
+        # a refusal is remembered like a token, so the next module runs don't ask again right away
+        refused = dict(refused=True, expires=time.time() + TOKEN_REFUSED_TTL)
+        try:
+            token = self.request('POST', '/v3/tokens', data=data, headers={'Authorization': basic}).json()
+        except urllib_request.HTTPError as e:
+            return refused if e.code < 500 else None
+        if not token.get('token'):
+            return refused
+        expires = time.time() + self.tokens.ttl
+        if token.get('expiresAt'):
+            expires = min(expires, calendar.timegm(time.strptime(token['expiresAt'], '%Y-%m-%dT%H:%M:%SZ')))
+        return dict(token=token['token'], name=token.get('name'), expires=expires)
+
+    def _retry_delay(self, attempt, response):
+        # Retry-After when Rancher sends one, otherwise half to all of the doubled delay
+        retry_after = retry_after_seconds(response.getheader('Retry-After')) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.retry_max_delay)
+        delay = min(self.retry_delay * 2 ** attempt, self.retry_max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def close(self):
+        with self._lock:
+            idle = dict(self._idle)
+            self._idle.clear()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _acquire(self, key, fresh=False):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns and not fresh:
+                return conns.pop(), True
+        return self._connect(*key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.pool_size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'http':
+            return http_client.HTTPConnection(netloc, timeout=self.timeout)
+
+        if self.validate_certs:
+            context = ssl.create_default_context()
+        else:
+            context = ssl._create_unverified_context()
+
+        proxy = getproxies().get('https')
+        if proxy and not proxy_bypass(netloc.split(':')[0]):
+            conn = http_client.HTTPSConnection(urlsplit(proxy).netloc, timeout=self.timeout, context=context)
+            conn.set_tunnel(netloc)
+            return conn
+
+        return http_client.HTTPSConnection(netloc, timeout=self.timeout, context=context)
+
+
+class RancherRateLimiter(object):
+
+    # a token bucket (rate requests per second, up to burst at once) and a limit of requests in flight per
+    # server, shared by all processes through a locked JSON file, nothing is limited with both set to 0
+
+    def __init__(self, path, host, rate, burst, max_in_flight):
+        self.path = path
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.pid = str(os.getpid())
+
+    def acquire(self):
+        # returns the seconds spent waiting
+        if self.rate <= 0 and self.max_in_flight <= 0:
+            return 0.0
+
+        started = time.time()
+        while True:
+            wait = self._update(self._take)
+            if wait is None:
+                return time.time() - started
+            time.sleep(wait)
+
+    def release(self):
+        if self.max_in_flight > 0:
+            self._update(self._give)
+
+    def _take(self, state, now):
+        if self.rate > 0:
+            state['tokens'] = min(self.burst, state.get('tokens', self.burst) + (now - state.get('updated', now)) * self.rate)
+            state['updated'] = now
+
+        in_flight = state.setdefault('in_flight', {})
+        if self.max_in_flight > 0 and sum(in_flight.values()) >= self.max_in_flight:
+            # processes that died with requests in flight must not hold their slots forever
+            for pid in list(in_flight):
+                if not pid_alive(int(pid)):
+                    del in_flight[pid]
+            if sum(in_flight.values()) >= self.max_in_flight:
+                return 0.05
+
+        if self.rate > 0:
+            if state['tokens'] < 1:
+                return (1 - state['tokens']) / self.rate
+            state['tokens'] -= 1
+        if self.max_in_flight > 0:
+            in_flight[self.pid] = in_flight.get(self.pid, 0) + 1
+        return None
+
+    def _give(self, state, now):
+        in_flight = state.setdefault('in_flight', {})
+        if in_flight.get(self.pid, 0) > 1:
+            in_flight[self.pid] -= 1
+        else:
+            in_flight.pop(self.pid, None)
+
+    def _update(self, change):
+        # the state is rewritten in place under an exclusive lock, a rename per request would cost more
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    content = json.loads(f.read() or '{}')
+                except ValueError:
+                    content = {}
+                result = change(content.setdefault(self.host, {}), time.time())
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(content))
+                return result
+        except (IOError, OSError):
+            # like the caches, a limiter that can't keep its state must not fail the module
+            return None
+
+
+class RancherTokenCache(object):
+
+    # bearer tokens by server and API key, also kept in memory for the module runs of the action plugins
+    _tokens = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path, host, user, password, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.basic = "Basic {}".format(base64.b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii'))
+        # a new secret for the same key must not pick up the token of the old one
+        self.key = '{} {} {}'.format(host, user, hashlib.sha256(self.basic.encode('utf-8')).hexdigest()[:16])
+
+    def valid(self, entry):
+        margin = 0 if entry and entry.get('refused') else min(300, self.ttl / 10.0)
+        return bool(entry) and entry['expires'] - time.time() > margin
+
+    def header(self, login, stale=None):
+        if self.ttl <= 0:
+            return self.basic
+
+        with self._lock:
+            entry = self._tokens.get(self.key)
+            if not self.valid(entry) or (stale and self.bearer(entry) == stale):
+                entry = self._refresh(login, stale)
+                self._tokens[self.key] = entry
+        return self.bearer(entry) or self.basic
+
+    def bearer(self, entry):
+        # None for a refused login, the API key is sent instead
+        return 'Bearer {}'.format(entry['token']) if entry and entry.get('token') else None
+
+    def _refresh(self, login, stale):
+        # under the file lock, so parallel forks log in once and the others pick up the token
+        found = []
+
+        def change(content):
+            now = time.time()
+            for key in [key for key, entry in content.items() if entry.get('expires', 0) <= now]:
+                del content[key]
+
+            entry = content.get(self.key)
+            if not found and (not self.valid(entry) or (stale and self.bearer(entry) == stale)):
+                found.append(login(self.basic))
+            elif not found:
+                found.append(entry)
+
+            if found[0]:
+                content[self.key] = found[0]
+            else:
+                content.pop(self.key, None)
+            return content
+
+        update_json_file(self.path, change)
+        return found[0]
+
+
+class RancherCircuitBreaker(object):
+
+    # one per server and process, shared by all clients like the connection pool
+    _breakers = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host, threshold, cooldown):
+        with cls._registry_lock:
+            breaker = cls._breakers.setdefault(host, cls())
+        breaker.threshold, breaker.cooldown = threshold, cooldown
+        return breaker
+
+    def __init__(self):
+        self.threshold = DEFAULT_CIRCUIT_THRESHOLD
+        self.cooldown = DEFAULT_CIRCUIT_COOLDOWN
+        self.failures = 0
+        self.opened = None
+        self.trial = None  # (request, started) of the one request let through after the cooldown
+        self._lock = threading.Lock()
+
+    def allow(self, request):
+        # after the cooldown one request, with its retries, may try again and the others are turned away until
+        # it succeeds or fails.  A failure opens the breaker again, a trial that never reports back expires
+        with self._lock:
+            now = time.time()
+            if self.threshold <= 0 or self.opened is None:
+                return True
+            if self.trial and self.trial[0] is request:
+                return True
+            if now < self.opened + self.cooldown or (self.trial and now < self.trial[1] + self.cooldown):
+                return False
+            self.trial = (request, now)
+            return True
+
+    def remaining(self):
+        with self._lock:
+            return max(0, self.opened + self.cooldown - time.time()) if self.opened else 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if 0 < self.threshold <= self.failures:
+                self.opened = time.time()
+            self.trial = None
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = None
+
+
+class RancherMetrics(object):
+
+    # one span per request: method, url template, status, seconds, bytes and retries
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.started = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, span, started, **fields):
+        span = dict(span, start=round(started, 6), seconds=round(time.time() - started, 6), **fields)
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+
+        endpoints = {}
+        for span in spans:
+            endpoint = endpoints.setdefault('{} {}'.format(span['method'], span['url']), dict(requests=0, seconds=0.0))
+            endpoint['requests'] += 1
+            endpoint['seconds'] = round(endpoint['seconds'] + span['seconds'], 6)
+
+        # http_seconds adds up concurrent requests, module_seconds is the wall time since the client was made
+        return dict(
+            requests=len(spans),
+            errors=len([span for span in spans if span.get('error') or span.get('status', 0) >= 400]),
+            retries=sum(span['retries'] for span in spans),
+            retry_seconds=round(sum(span['waited'] for span in spans), 3),
+            throttle_seconds=round(sum(span['throttled'] for span in spans), 3),
+            connections=len([span for span in spans if not span.get('reused')]),
+            bytes_sent=sum(span['sent'] for span in spans),
+            bytes_received=sum(span.get('received', 0) for span in spans),
+            http_seconds=round(sum(span['seconds'] for span in spans), 6),
+            module_seconds=round(time.time() - self.started, 6),
+            concurrency=peak_concurrency(spans),
+            endpoints=endpoints,
+        )
+
+    def flush(self, module_name=None):
+        # appended in one locked write, so the spans of parallel module runs don't interleave
+        with self._lock:
+            spans, self.spans = self.spans, []
+        if not self.trace_path or not spans:
+            return
+        lines = ''.join(json.dumps(dict(span, module=module_name, pid=os.getpid()), sort_keys=True) + '\n'
+                        for span in spans)
+        try:
+            with open(self.trace_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(lines)
+        except (IOError, OSError):
+            pass
+
+    def wrap(self, module, exit):
+        def exit_with_metrics(*args, **kwargs):
+            if 'rancher_metrics' not in kwargs:
+                kwargs['rancher_metrics'] = self.summary()
+                self.flush(getattr(module, '_name', None))
+            exit(*args, **kwargs)
+        return exit_with_metrics
+
+
+class RancherIdCache(object):
+
+    # (host, resource type, name) -> id and self link, shared by all module runs through a JSON file
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._entries = self._load() if ttl > 0 else {}
+
+    def get(self, host, kind, name):
+        entry = self._entries.get(self._key(host, kind, name))
+        if entry and entry['expires'] > time.time():
+            return dict(id=entry['id'], name=name, links=dict(self=entry['self']))
+        return None
+
+    def set(self, host, kind, items):
+        if self.ttl <= 0:
+            return
+
+        expires = time.time() + self.ttl
+        entries = dict((self._key(host, kind, item['name']),
+                        dict(id=item['id'], self=item.get('links', {}).get('self'), expires=expires))
+                       for item in items if item.get('name') and item.get('id'))
+        self._update(lambda current: current.update(entries))
+
+    def invalidate(self, host, url):
+        if self.ttl <= 0:
+            return
+
+        path = url.split('?')[0].rstrip('/')
+        segments = path.split('/')
+
+        def stale(key, entry):
+            return key.startswith(host + ' ') and (entry['self'] == path or entry['id'] in segments)
+
+        if any(stale(key, entry) for key, entry in self._entries.items()):
+            self._update(lambda current: [current.pop(key) for key, entry in list(current.items()) if stale(key, entry)])
+
+    @staticmethod
+    def _key(host, kind, name):
+        return ' '.join((host, kind, name))
+
+    def _load(self):
+        return load_json_file(self.path)
+
+    def _update(self, change):
+        def expire(entries):
+            change(entries)
+            now = time.time()
+            return dict((key, entry) for key, entry in entries.items() if entry['expires'] > now)
+
+        self._entries = update_json_file(self.path, expire)
+
+
+class RancherSnapshot(object):
+
+    # host -> collection -> {fetched, etag, revision, data}, written by rancher_facts
+
+    def __init__(self, path, host, max_age):
+        self.path = path
+        self.host = host
+        self.max_age = max_age
+        self._collections = None
+
+    def collections(self):
+        if self._collections is None:
+            self._collections = load_json_file(self.path).get(self.host) or {}
+        return self._collections
+
+    def entry(self, kind):
+        return self.collections().get(kind)
+
+    def items(self, kind):
+        # None unless the collection was snapshotted less than max_age seconds ago
+        if self.max_age <= 0:
+            return None
+        entry = self.entry(kind)
+        if not entry or entry['fetched'] + self.max_age < time.time():
+            return None
+        return entry['data']
+
+    def save(self, entries):
+        def change(content):
+            content.setdefault(self.host, {}).update(entries)
+            return content
+
+        self._collections = update_json_file(self.path, change).get(self.host) or {}
+
+    def invalidate(self, path):
+        # /v3/clusters/c-xxxxx -> cluster
+        segments = path.split('/')
+        if len(segments) < 3 or not os.path.exists(self.path):
+            return
+        kind = segments[2].lower()
+        kind = kind[:-1] if kind.endswith('s') else kind
+        stale = [kind] + SNAPSHOT_DEPENDENTS.get(kind, [])
+        if not any(key in self.collections() for key in stale):
+            return
+
+        def change(content):
+            collections = content.get(self.host) or {}
+            for key in stale:
+                collections.pop(key, None)
+            return content
+
+        self._collections = update_json_file(self.path, change).get(self.host) or {}
+
+
+def load_json_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def update_json_file(path, change):
+    # read-modify-write under an exclusive lock so parallel forks don't drop each other's entries
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            content = change(load_json_file(path))
+
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(content, f)
+            os.rename(tmp, path)
+    except (IOError, OSError):
+        # the files are an optimization only, a read-only or full disk must not fail the module
+        content = change(load_json_file(path))
+    return content
+
+
+def project(resource, fields):
+    # keep only the (dotted) fields of an object, or of every object of a collection
+    if not resource or '*' in fields:
+        return resource
+
+    if resource.get('type') == 'collection':
+        return dict(type='collection', pagination=resource.get('pagination'),
+                    data=[project(item, fields) for item in resource.get('data') or []])
+
+    projection = {}
+    for field in fields:
+        value, target, keys = resource, projection, field.split('.')
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return projection
+
+
+def rancher_argument_spec():
+    # the client options of every module, merged into its own argument_spec like url_argument_spec()
+    return dict(
+        cache_ttl=dict(type='int', required=False),   # default: 300 seconds or RANCHER_CACHE_TTL, 0 disables
+        cache_path=dict(type='str', required=False),  # default: ~/.ansible/tmp/rancher_ids.json or RANCHER_CACHE_PATH
+        snapshot_max_age=dict(type='int', required=False),  # default: 0 or RANCHER_SNAPSHOT_MAX_AGE, see rancher_facts
+        trace_path=dict(type='path', required=False),  # append one JSON line per request, or RANCHER_TRACE_PATH
+        retries=dict(type='int', required=False),        # default: 4 or RANCHER_RETRIES, for busy or unreachable servers
+        retry_delay=dict(type='float', required=False),  # default: 1 second or RANCHER_RETRY_DELAY, doubled per retry
+        request_timeout=dict(type='float', required=False),  # default: 30 seconds or RANCHER_TIMEOUT per answer
+        return_fields=dict(type='list', elements='str', required=False),  # default: id, name, state and links, ['*'] for all
+    )
+
+
+def fleet_argument_spec():
+    # the options of the info modules that read several Rancher servers at once, see list_objects()
+    return dict(
+        # several Rancher servers at once instead of host, the result is merged and each object tagged with its host
+        hosts=dict(type='list', elements='dict', required=False, options=dict(
+            host=dict(type='str', required=True),
+            user=dict(type='str', required=False),                   # default: user
+            password=dict(type='str', required=False, no_log=True),  # default: password
+            timeout=dict(type='int', required=False),                # default: host_timeout
+        )),
+        host_timeout=dict(type='int', required=False, default=DEFAULT_HOST_TIMEOUT),  # a slower server is reported as failed
+    )
+
+
+def setting(module, name, env, default, convert):
+    value = module.params.get(name)
+    if value is None:
+        value = os.environ.get(env, default)
+    return convert(value)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def http_error(url, status, reason, body=None, headers=None):
+    # the modules fail with json.loads(e.fp.read()), so errors without a JSON body get one
+    try:
+        json.loads(body)
+    except (TypeError, ValueError):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        body = json.dumps(dict(type='error', status=status, code=reason,
+                               message=(body or reason).strip()[:1000])).encode('utf-8')
+    return urllib_request.HTTPError(url, status, reason, headers, BytesIO(body))
+
+
+def retry_after_seconds(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        return max(0.0, mktime_tz(parsed) - time.time()) if parsed else None
+
+
+def url_template(url):
+    # https://host/v3/clusters/c-x2b4f?name=a&limit=1 -> /v3/clusters/{id}?limit&name, action values are kept
+    parts = urlsplit(url)
+    segments = parts.path.split('/')
+    if len(segments) > 3 and segments[1] == 'v3' and segments[3]:
+        segments[3] = '{id}'
+    query = sorted(key if key != 'action' else '{}={}'.format(key, value)
+                   for key, value in parse_qsl(parts.query, keep_blank_values=True))
+    return '/'.join(segments) + ('?' + '&'.join(query) if query else '')
+
+
+def lookup(item, field):
+    for key in field.split('.'):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(key)
+    return item
+
+
+def matches(item, match):
+    # client side filter, each (dotted) field must equal the value or be one of a list of values
+    for field, wanted in match.items():
+        value = lookup(item, field)
+        if value != wanted and not (isinstance(wanted, list) and value in wanted):
+            return False
+    return True
+
+
+def write_ndjson(path, items):
+    # one JSON object per line, written to a temporary file first so readers never see a partial file
+    path = os.path.expanduser(path)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.rancher')
+    count = 0
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+                count += 1
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return count
+
+
+def run_concurrently(function, items, workers=4):
+    # map function over items on a bounded worker pool, results are returned in input order
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def fleet_clients(module):
+    # one client per entry of hosts, user and password default to the module's own
+    clients = []
+    for entry in module.params.get('hosts'):
+        user = entry.get('user') or module.params.get('user')
+        password = entry.get('password') or module.params.get('password')
+        if not user or not password:
+            module.fail_json(msg="missing user or password for the Rancher server {}".format(entry['host']))
+        timeout = entry.get('timeout') or module.params.get('host_timeout') or DEFAULT_HOST_TIMEOUT
+        clients.append(RancherClient(module, host=entry['host'], user=user, password=password, timeout=timeout,
+                                     metrics=clients[0].metrics if clients else None))
+    return clients
+
+
+def fan_out(clients, function):
+    # function(client) for all servers at once, each in a daemon thread of its own: a server that hasn't
+    # answered within its client's timeout is reported as timed out and left behind, it doesn't hold up the
+    # result or the module's exit.  Returns dict(host, seconds, result or error) per client, in order
+    started = time.time()
+    outcomes = [None] * len(clients)
+
+    def run(index, client):
+        start = time.time()
+        try:
+            outcome = dict(result=function(client))
+        except Exception as e:
+            outcome = dict(error=e)
+        outcomes[index] = dict(outcome, seconds=round(time.time() - start, 3))
+
+    threads = [threading.Thread(target=run, args=(index, client)) for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread, client in zip(threads, clients):
+        thread.join(max(0, started + client.timeout - time.time()))
+
+    finished = list(outcomes)
+    return [dict(outcome or dict(seconds=client.timeout, error=http_error(
+        client.base_url, 504, 'Timeout', 'No answer within {} seconds'.format(client.timeout))), host=client.host)
+        for client, outcome in zip(clients, finished)]
+
+
+def fleet_result(outcomes):
+    # the items of all servers that answered in one list, and per server its count or why it failed
+    data, hosts = [], []
+    for outcome in outcomes:
+        entry = dict(host=outcome['host'], seconds=outcome['seconds'])
+        if 'error' in outcome:
+            entry.update(failed=True, msg=error_message(outcome['error']))
+        else:
+            entry.update(count=len(outcome['result']))
+            data.extend(outcome['result'])
+        hosts.append(entry)
+    return data, hosts
+
+
+def list_objects(module, kind, fields=(), read=None, client=None):
+    # exits with the objects read(client) returns, by default the one named name or the whole collection of kind
+    # with filters, match and page_size, projected to fields and returned or written to ndjson_path.  Without a
+    # client the same read runs against every server of hosts at once, servers that fail leave out their objects
+    def collection(client):
+        if module.params.get('name'):
+            items = client.get('/v3/{}'.format(kind), params={'name': module.params.get('name'), 'limit': 1}).json()
+            client.remember(kind, items.get('data') or [])
+            return items.get('data') or []
+        return client.iter_collection('/v3/{}'.format(kind), params=module.params.get('filters'),
+                                      match=module.params.get('match'), page_size=module.params.get('page_size'))
+    read = read or collection
+
+    result = {}
+    if client:
+        items = (client.project(item, *fields) for item in read(client))
+    else:
+        items, result['hosts'] = fleet_result(fan_out(fleet_clients(module), lambda client: [
+            dict(client.project(item, *fields), host=client.host) for item in read(client)]))
+        if not any('count' in entry for entry in result['hosts']):
+            module.fail_json(msg="Failed on every Rancher server: {}".format(
+                ", ".join(entry['host'] for entry in result['hosts'])), **result)
+
+    if module.params.get('ndjson_path'):
+        count = write_ndjson(module.params.get('ndjson_path'), items)
+        module.exit_json(changed=False, count=count, ndjson_path=module.params.get('ndjson_path'), **result)
+    data = list(items)
+    module.exit_json(changed=False, count=len(data), resource=dict(type='collection', data=data), **result)
+
+
+def peak_concurrency(spans):
+    # the most requests that were in flight at the same time, a request ending as another starts doesn't overlap
+    edges = sorted([(span['start'], 1) for span in spans] + [(span['start'] + span['seconds'], -1) for span in spans])
+    peak = current = 0
+    for edge, change in edges:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def error_message(error):
+    if isinstance(error, urllib_request.HTTPError):
+        return json.loads(error.fp.read())
+    return str(error)
+
+
+def run_graph(steps, workers=4):
+    # steps: name -> (function, names of the steps it depends on), function(results) gets the results of the
+    # steps done so far.  Returns name -> dict(result or error or skipped, start and seconds from the start)
+    unknown = set(dependency for function, dependencies in steps.values() for dependency in dependencies) - set(steps)
+    if unknown:
+        raise ValueError("Unknown steps: {}".format(", ".join(sorted(unknown))))
+
+    started = time.time()
+    done, results, running = {}, {}, {}
+
+    def timed(function):
+        start = time.time()
+        try:
+            outcome = dict(result=function(results))
+        except Exception as e:
+            outcome = dict(error=e)
+        return dict(outcome, start=round(start - started, 3), seconds=round(time.time() - start, 3))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        while len(done) < len(steps):
+            for name, (function, dependencies) in steps.items():
+                if name in done or name in running:
+                    continue
+                if any('result' not in done[dependency] for dependency in dependencies if dependency in done):
+                    done[name] = dict(skipped=True, start=round(time.time() - started, 3), seconds=0.0)
+                elif all(dependency in done for dependency in dependencies):
+                    running[name] = executor.submit(timed, function)
+
+            if not running:
+                # whatever is left depends on itself
+                for name in set(steps) - set(done):
+                    done[name] = dict(skipped=True, start=round(time.time() - started, 3), seconds=0.0)
+                break
+
+            finished = wait(list(running.values()), return_when=FIRST_COMPLETED)[0]
+            for name, future in list(running.items()):
+                if future in finished:
+                    done[name] = future.result()
+                    if 'result' in done[name]:
+                        results[name] = done[name]['result']
+                    del running[name]
+    return done
+
+
+def nodedriver_data(spec):
+    data = {
+        'name': spec.get('name'),
+        'active': True,
+        'builtin': False,
+        'url': spec.get('url'),
+        'uiUrl': spec.get('uiUrl'),
+        'whitelistDomains': spec.get('whitelist_domains') or DEFAULT_WHITELIST_DOMAINS,
+    }
+    # Rancher checks the downloaded binary against it
+    if spec.get('checksum'):
+        data['checksum'] = spec.get('checksum')
+    return data
+
+
+def nodedriver_changes(driver, data):
+    # a changed url or checksum makes Rancher download the driver again, the rest is updated as is
+    return dict((key, value) for key, value in data.items()
+                if key in ('url', 'uiUrl', 'checksum', 'whitelistDomains') and value is not None
+                and driver.get(key) != value)
+
+
+def template_data(spec):
+    return {
+        "name": spec.get('name'),
+        "eportalConfig": {
+            "cpu": spec.get('cpu'),
+            "memory": spec.get('memory'),
+            "disk": spec.get('disk'),
+            "location": spec.get('region'),
+            "os": spec.get('image'),
+            # "sshUser": spec.get('ssh_user'), # because local_prodadmin is baked into eportal backend anyway
+            "server": spec.get('server'),
+            "token": spec.get('token'),
+            "vlan": spec.get('network'),
+        },
+        "engineInstallURL": spec.get('engine_install_url'),
+        "engineStorageDriver": spec.get('engine_storage_driver'),
+        "engineOpt": spec.get('engine_options'),
+        "labels": spec.get('labels')
+    }
+
+
+def cluster_data(spec):
+    data = {
+        "name": spec.get('name'),
+        "dockerRootDir": "/var/lib/docker",
+        "enableClusterAlerting": False,
+        "enableClusterMonitoring": False,
+        "enableNetworkPolicy": False,
+        "rancherKubernetesEngineConfig": {
+            "addonJobTimeout": 30,
+            "ignoreDockerVersion": True,
+            # "cloudProvider": "{{ cloudProvider if k8s[site_name].dynamic_volume_provisioning else omit }}",
+            "sshAgentAuth": False,
+            "kubernetesVersion": spec.get("kubernetes_version"),  # v1.14.5-rancher1-1
+            "authentication": {
+                "strategy": "x509"
+            },
+            "network": {
+                "plugin": spec.get("cni_provider")  # calico
+            },
+            "ingress": {
+                "provider": spec.get("ingress_provider")  # nginx
+            },
+            "monitoring": {
+                "provider": "metrics-server"
+            },
+            "services": {
+                "kubeApi": {
+                    "alwaysPullImages": False,
+                    "podSecurityPolicy": False,
+                    "serviceNodePortRange": "30000-32767"
+                },
+                "etcd": {
+                    "creation": "12h",
+                    "extraArgs": {
+                        "heartbeat-interval": 500,
+                        "election-timeout": 5000
+                    },
+                    "retention": "72h",
+                    "snapshot": False,
+                    "backupConfig": {
+                        "enabled": True,
+                        "intervalHours": 12,
+                        "retention": 6
+                    }
+                }
+            }
+        },
+        "localClusterAuthEndpoint": {
+            "enabled": True
+        }
+    }
+
+    # https://rancher.com/docs/rke/latest/en/config-options/cloud-providers/vsphere/config-reference/
+    if spec.get('enable_dvp'):
+        cloud_provider = {
+            "name": "vsphere",
+            "vsphereCloudProvider": {
+                "global": {
+                    "insecure-flag": True,
+                    "soap-roundtrip-count": 0
+                },
+                "virtualCenter": {
+                    spec["vcenter_host"]: {
+                        "datacenters": spec.get('region'),
+                        "user": spec["vcenter_user"],
+                        "password": spec["vcenter_password"]
+                    }
+                },
+                "workspace": {
+                    "datacenter": spec.get('region'),
+                    "default-datastore": spec["vcenter_datastore"],
+                    "folder": spec["vcenter_machine_folder"],  # for dummy VMs used for volume provisioning
+                    "server": spec["vcenter_host"]
+                }
+            }
+        }
+        data['rancherKubernetesEngineConfig'].update({'cloudProvider': cloud_provider})
+    return data
+
+
+def pool_data(spec, cluster_id, template_id):
+    return {
+        "name": spec.get('name'),
+        "clusterId": cluster_id,
+        "nodeTemplateId": template_id,
+        "hostnamePrefix": spec.get('prefix'),
+        "quantity": spec.get('quantity'),
+        "controlPlane": spec.get('controlplane'),
+        "etcd": spec.get('etcd'),
+        "worker": spec.get('worker'),
+    }
+
+
+def pool_changes(pool, data):
+    # name and cluster can't be changed on an existing pool
+    return dict((key, value) for key, value in data.items()
+                if key not in ('name', 'clusterId') and pool.get(key) != value)
+
+
+def spec_hash(data, secret):
+    # canonical JSON, so key order doesn't matter.  Passwords go in as an HMAC keyed with secret, the API
+    # secret key, which Rancher doesn't store: a changed password changes the hash, and whoever can read the
+    # cluster can't test guesses against the annotation without also knowing the secret key
+    def redact(value):
+        if isinstance(value, dict):
+            return dict((key, secret_digest(item, secret) if key == 'password' and item else redact(item))
+                        for key, item in value.items())
+        if isinstance(value, list):
+            return [redact(item) for item in value]
+        return value
+    return hashlib.sha256(json.dumps(redact(data), sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def secret_digest(value, secret):
+    return hmac.new(str(secret).encode('utf-8'), str(value).encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def annotate(data, secret):
+    annotations = dict(data.get('annotations') or {}, **{SPEC_HASH_ANNOTATION: spec_hash(data, secret)})
+    return dict(data, annotations=annotations)
+
+
+def contains(current, wanted):
+    # wanted is a subset of current, Rancher adds defaults and returns map[string]string values as strings
+    if isinstance(wanted, dict):
+        return isinstance(current, dict) and all(contains(current.get(key), value) for key, value in wanted.items())
+    if isinstance(wanted, list):
+        return isinstance(current, list) and len(current) == len(wanted) and all(
+            contains(item, value) for item, value in zip(current, wanted))
+    if isinstance(current, str) and not isinstance(wanted, str) and wanted is not None:
+        return current == (json.dumps(wanted) if isinstance(wanted, bool) else str(wanted))
+    return current == wanted
+
+
+def merge(current, wanted):
+    if isinstance(current, dict) and isinstance(wanted, dict):
+        return dict(current, **dict((key, merge(current.get(key), value)) for key, value in wanted.items()))
+    return wanted
+
+
+def cluster_changes(cluster, data, secret):
+    # (None, []) while the stored hash matches data, otherwise the body to PUT and the names of the fields that
+    # differ: the top level fields, the RKE config with only its differing subtrees replaced, and the new hash
+    digest = spec_hash(data, secret)
+    annotations = cluster.get('annotations') or {}
+    if annotations.get(SPEC_HASH_ANNOTATION) == digest:
+        return None, []
+
+    changes = dict((key, value) for key, value in data.items()
+                   if key not in ('name', 'annotations', 'rancherKubernetesEngineConfig')
+                   and not contains(cluster.get(key), value))
+    fields = sorted(changes)
+
+    # Rancher replaces the RKE config as a whole, the subtrees that didn't change are sent back as they are
+    current = cluster.get('rancherKubernetesEngineConfig') or {}
+    wanted = data.get('rancherKubernetesEngineConfig') or {}
+    subtrees = sorted(key for key, value in wanted.items() if not contains(current.get(key), value))
+    if subtrees:
+        changes['rancherKubernetesEngineConfig'] = dict(current, **dict(
+            (key, merge(current.get(key), wanted[key])) for key in subtrees))
+        fields += ['rancherKubernetesEngineConfig.{}'.format(key) for key in subtrees]
+
+    changes['annotations'] = dict(annotations, **{SPEC_HASH_ANNOTATION: digest})
+    return changes, fields
+
+
+def find(client, kind, name, params=None):
+    # the object of that kind and name or None, and the query() response it came from
+    result = client.query(kind, dict(params or {}, name=name, limit=1))
+    items = [item for item in result.iter_items() if item.get('name') == name]
+    return (items[0] if items else None), result
+
+
+def applied(result, changes=None, changed=True):
+    # what the *_apply() functions return for a POST or PUT: the object as written, and the changed fields
+    outcome = dict(changed=changed, resource=result.json(), status=result.status, reason=result.reason)
+    if changes is not None:
+        outcome['changes'] = changes
+    return outcome
+
+
+def nodedriver_apply(client, spec, driver=None):
+    # creates the node driver, or sends the fields of the existing driver that differ from spec
+    data = nodedriver_data(spec)
+    if not driver:
+        return applied(client.post('/v3/nodedriver', data=data))
+
+    changes = nodedriver_changes(driver, data)
+    if not changes:
+        return dict(changed=False, resource=driver)
+    return applied(client.put(driver['links'].get('update') or driver['links']['self'], data=changes), sorted(changes))
+
+
+def cluster_apply(client, spec, cluster=None, from_snapshot=False):
+    # the API secret key keys the password digests of the spec hash, see spec_hash()
+    data, secret = cluster_data(spec), spec.get('password')
+    if not cluster:
+        outcome = applied(client.post('/v3/cluster', data=annotate(data, secret)))
+        client.remember('cluster', [outcome['resource']])
+        return outcome
+
+    # a matching hash settles it without looking at the RKE config
+    changes, fields = cluster_changes(cluster, data, secret)
+    if changes and from_snapshot:
+        # the body is built from the current cluster, not from a snapshot of it
+        cluster = client.get(cluster['links']['self']).json()
+        changes, fields = cluster_changes(cluster, data, secret)
+    if not changes:
+        return dict(changed=False, resource=cluster)
+
+    # clusters created before the hash was kept get it recorded, that alone is no change
+    return applied(client.put(cluster['links'].get('update') or cluster['links']['self'], data=changes), fields,
+                   changed=bool(fields))
+
+
+def pool_apply(client, spec, cluster_id, template_id, pool=None):
+    data = pool_data(spec, cluster_id, template_id)
+    if not pool:
+        return applied(client.post('/v3/nodepool', data=data))
+
+    # only the differing fields are sent, so scaling or a role change happens in place
+    changes = pool_changes(pool, data)
+    if not changes:
+        return dict(changed=False, resource=pool)
+    return applied(client.put(pool['links'].get('update') or pool['links']['self'], data=changes), sorted(changes))
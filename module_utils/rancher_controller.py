@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Runs the rancher_* modules inside the Ansible worker process for the action plugins in action_plugins/.
+#
+# The modules only talk HTTP to Rancher from localhost, so packaging them with AnsiballZ, writing them to a
+# temporary directory and starting a new interpreter for every task (and every loop item or until retry)
+# buys nothing.  The module's main() is called directly instead: its arguments are handed over through
+# basic._ANSIBLE_ARGS and the JSON it prints before exiting is parsed like any other module result.
+#
+# This file is controller only, it is not shipped to hosts with the modules.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import io
+import os
+import sys
+import traceback
+from importlib.util import module_from_spec, spec_from_file_location
+
+from ansible.module_utils import basic
+from ansible.module_utils._text import to_bytes
+from ansible.module_utils.basic import json
+from ansible.plugins.action import ActionBase
+
+
+def load_source(name, path):
+    # loaded once per process, so the connection pool of module_utils/rancher.py is shared by all runs
+    if name not in sys.modules:
+        spec = spec_from_file_location(name, path)
+        module = module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except Exception:
+            del sys.modules[name]
+            raise
+    return sys.modules[name]
+
+
+def load_library_module(name, path):
+    # the modules import their client as ansible.module_utils.rancher
+    load_source('ansible.module_utils.rancher', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rancher.py'))
+    return load_source('ansible_rancher_library_{}'.format(name), path)
+
+
+def run_module(module, args):
+    # AnsibleModule reads its arguments from _ANSIBLE_ARGS and prints its result before calling sys.exit()
+    basic._ANSIBLE_ARGS = to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': args}))
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        module.main()
+        rc = 0
+    except SystemExit as e:
+        rc = e.code or 0
+    except Exception:
+        return dict(rc=1, stdout='', stderr=traceback.format_exc())
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+        basic._ANSIBLE_ARGS = None
+    return dict(rc=rc, stdout=output, stderr='')
+
+
+class RancherAction(ActionBase):
+
+    TRANSFERS_FILES = False
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(RancherAction, self).run(tmp, task_vars)
+        del tmp
+
+        # anywhere but on the controller itself the module runs the usual way
+        if self._play_context.connection != 'local':
+            result.update(self._execute_module(task_vars=task_vars))
+            return result
+
+        name = self._task.action
+        path = self._shared_loader_obj.module_loader.find_plugin(name, '.py')
+        module = load_library_module(name, path)
+
+        args = self._task.args.copy()
+        self._update_module_args(name, args, task_vars)
+
+        result.update(self._parse_returned_data(run_module(module, args)))
+        return result